@@ -0,0 +1,83 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+Compare the installed JSON backends (see :mod:`foxglove.json_codec`) reading the example
+flowerpots.
+
+The example flowerpots are tiny so their records are repeated to make a bigger flowerpot.
+e.g.
+python -m benchmarks.json_backends --repeat 20000
+"""
+import argparse
+import io
+import os
+import tarfile
+import tempfile
+import time
+
+from foxglove.connectors.flowerpot import FlowerPotConnector, FlowerpotEngine
+from foxglove.json_codec import available_backends, get_codec
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__)) + '/../'
+EXAMPLE_FLOWERPOTS = [BASE_DIR + 'examples/data/poisonous_animals.flowerpot',
+                      BASE_DIR + 'integration-tests/exampleflowerpot.tar.gz',
+                      ]
+
+
+def example_lines():
+    """
+    :returns: (list of bytes) every ndjson line in the example flowerpots
+    """
+    lines = []
+    for flowerpot_path in EXAMPLE_FLOWERPOTS:
+        engine = FlowerpotEngine.from_filename(flowerpot_path, use_index=False)
+        for _, fh in engine.file_handles():
+            lines.extend(line for line in fh if not line.isspace())
+            fh.close()
+    return lines
+
+
+def make_flowerpot(path, lines, repeat):
+    contents = b''.join(lines) * repeat
+    with tarfile.open(path, 'w:gz') as tf:
+        tar_info = tarfile.TarInfo(name='animals_0.ndjson')
+        tar_info.size = len(contents)
+        tf.addfile(tar_info, io.BytesIO(contents))
+
+
+def time_it(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=10000,
+                        help="number of times the example records are repeated")
+    args = parser.parse_args()
+
+    lines = example_lines()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        flowerpot_path = os.path.join(temp_dir, 'benchmark.flowerpot')
+        make_flowerpot(flowerpot_path, lines, args.repeat)
+        records = len(lines) * args.repeat
+        print(f"{records} records")
+        print(f"{'backend':<10}{'loads only (s)':>16}{'connector (s)':>16}{'records/s':>14}")
+
+        for backend in available_backends():
+            codec = get_codec(backend)
+            all_lines = lines * args.repeat
+            loads_time = time_it(lambda: [codec.loads(line) for line in all_lines])
+
+            connector = FlowerPotConnector(engine_url='flowerpot://' + flowerpot_path,
+                                           json_backend=backend)
+            connector_time = time_it(lambda: sum(1 for _ in connector.data))
+
+            print(f"{backend:<10}{loads_time:>16.3f}{connector_time:>16.3f}"
+                  f"{records/connector_time:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
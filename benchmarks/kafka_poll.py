@@ -0,0 +1,146 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+Messages per second read by :class:`foxglove.connectors.kafka_connector.KafkaConnector` with
+different 'max_poll_records' and partition settings.
+
+There's no broker. A stand-in consumer serves messages from memory and sleeps for
+--poll-latency milliseconds on every poll, like a fetch round trip to a broker would.
+e.g.
+python -m benchmarks.kafka_poll --messages 200000 --poll-latency 2
+"""
+import argparse
+from datetime import datetime
+import json
+import time
+from unittest.mock import patch
+
+from kafka.structs import OffsetAndTimestamp
+
+from foxglove.connectors.kafka_connector import KafkaConnector
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+START = datetime.strptime("2019-05-15 08:00:00", DATE_FORMAT)
+
+
+class StandInConsumer:
+    """
+    Enough of :class:`kafka.KafkaConsumer` for a KafkaConnector. Each of `partitions` has
+    `messages` / `partitions` messages, ten a second from START.
+    """
+    partitions = 3
+    messages = 100000
+    poll_latency = 0.001
+    _cache = {}
+
+    def __init__(self, max_poll_records=500, **config):
+        self.max_poll_records = max_poll_records
+        self.assigned = []
+        self.positions = {}
+        self.paused = set()
+        self.polls = 0
+        self.data = self._messages(self.partitions, self.messages // self.partitions)
+
+    @classmethod
+    def _messages(cls, partitions, per_partition):
+        key = (partitions, per_partition)
+        if key not in cls._cache:
+            start_ms = int(START.timestamp() * 1000)
+            cls._cache[key] = {p: [Message('stand_in', p, offset, start_ms + offset * 100, None,
+                                           json.dumps({'p': p, 'n': offset}).encode())
+                                   for offset in range(per_partition)]
+                               for p in range(partitions)}
+        return cls._cache[key]
+
+    def topics(self):
+        return {'stand_in'}
+
+    def partitions_for_topic(self, topic):
+        return set(self.data)
+
+    def offsets_for_times(self, timestamps):
+        r = {}
+        for tp, ts in timestamps.items():
+            messages = self.data[tp.partition]
+            offset = min(max(0, (ts - messages[0].timestamp) // 100), len(messages))
+            r[tp] = OffsetAndTimestamp(offset, ts, -1) if offset < len(messages) else None
+        return r
+
+    def end_offsets(self, partitions):
+        return {tp: len(self.data[tp.partition]) for tp in partitions}
+
+    def assign(self, partitions):
+        self.assigned = list(partitions)
+
+    def seek(self, tp, offset):
+        self.positions[tp] = offset
+
+    def position(self, tp):
+        return self.positions[tp]
+
+    def pause(self, *partitions):
+        self.paused.update(partitions)
+
+    def poll(self, timeout_ms=0, max_records=None):
+        time.sleep(self.poll_latency)
+        self.polls += 1
+        remaining = max_records or self.max_poll_records
+        r = {}
+        for tp in self.assigned:
+            if tp in self.paused or remaining <= 0:
+                continue
+            position = self.positions[tp]
+            messages = self.data[tp.partition][position:position + remaining]
+            if messages:
+                r[tp] = messages
+                self.positions[tp] += len(messages)
+                remaining -= len(messages)
+        return r
+
+
+class Message:
+    __slots__ = ('topic', 'partition', 'offset', 'timestamp', 'key', 'value')
+
+    def __init__(self, topic, partition, offset, timestamp, key, value):
+        self.topic = topic
+        self.partition = partition
+        self.offset = offset
+        self.timestamp = timestamp
+        self.key = key
+        self.value = value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--poll-latency', type=float, default=1.0,
+                        help="milliseconds each poll takes")
+    args = parser.parse_args()
+    StandInConsumer.messages = args.messages
+    StandInConsumer.poll_latency = args.poll_latency / 1000
+
+    per_partition = args.messages // StandInConsumer.partitions
+    # the last whole second with messages
+    end = datetime.fromtimestamp(START.timestamp() + (per_partition - 10) // 10)
+    engine_url = f"kafka://stand_in/topic=stand_in;start=@({START:{DATE_FORMAT}});" \
+                 f"end=@({end:{DATE_FORMAT}});"
+
+    print(f"{'max_poll_records':>18}{'partitions':>24}{'messages':>10}{'messages/s':>12}")
+    with patch('foxglove.connectors.kafka_connector.KafkaConsumer', StandInConsumer):
+        for max_poll_records in (10, 500, 5000):
+            for concurrent, ordering in ((False, 'timestamp'), (True, 'unordered'),
+                                         (True, 'timestamp')):
+                connector = KafkaConnector(engine_url=engine_url, record_type='raw',
+                                           max_poll_records=max_poll_records,
+                                           concurrent_partitions=concurrent, ordering=ordering)
+                connector.connect()
+                start = time.perf_counter()
+                count = sum(1 for _ in connector.data)
+                elapsed = time.perf_counter() - start
+                mode = f"concurrent {ordering}" if concurrent else "one at a time"
+                print(f"{max_poll_records:>18}{mode:>24}{count:>10}{count/elapsed:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
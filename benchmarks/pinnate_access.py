@@ -0,0 +1,79 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+Memory and time used by :class:`foxglove.pinnate.Pinnate` records, with plain dicts as a
+baseline.
+e.g.
+python -m benchmarks.pinnate_access --records 200000
+"""
+import argparse
+import time
+import tracemalloc
+
+from foxglove.pinnate import Pinnate
+
+
+def make_docs(count):
+    return [{'name': f'animal {i}',
+             'where': 'Australia',
+             'legs': i % 8,
+             'habitat': {'terrain': 'reef', 'depth': {'min': 1, 'max': 40}},
+             'diet': [{'food': 'fish'}, {'food': 'crab'}],
+             }
+            for i in range(count)]
+
+
+def time_it(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def bytes_per_record(docs, wrap):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    records = [wrap(d) for d in docs]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(records) == len(docs)
+    return (after - before) / len(docs)
+
+
+def access_pinnate(records):
+    for r in records:
+        r.name, r.where, r.habitat.terrain, r.habitat.depth.max, r.habitat.depth.min
+        r.diet[0].food, r.diet[1].food
+
+
+def access_dict(records):
+    for r in records:
+        r['name'], r['where'], r['habitat']['terrain'], r['habitat']['depth']['max']
+        r['habitat']['depth']['min'], r['diet'][0]['food'], r['diet'][1]['food']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+
+    docs = make_docs(args.records)
+    print(f"{args.records} records")
+    print(f"{'':<8}{'bytes/record':>14}{'wrap (s)':>12}{'access (s)':>12}"
+          f"{'re-access (s)':>15}")
+
+    pinnates = [Pinnate(d) for d in docs]
+    print(f"{'Pinnate':<8}"
+          f"{bytes_per_record(docs, Pinnate):>14.0f}"
+          f"{time_it(lambda: [Pinnate(d) for d in docs]):>12.3f}"
+          f"{time_it(lambda: access_pinnate(pinnates)):>12.3f}"
+          f"{time_it(lambda: access_pinnate(pinnates)):>15.3f}")
+    print(f"{'dict':<8}"
+          f"{0:>14.0f}"
+          f"{0:>12.3f}"
+          f"{time_it(lambda: access_dict(docs)):>12.3f}"
+          f"{time_it(lambda: access_dict(docs)):>15.3f}")
+
+
+if __name__ == '__main__':
+    main()
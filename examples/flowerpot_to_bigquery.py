@@ -17,12 +17,14 @@ class FlowerpotToBigquery(foxglove.Model):
 
     def build(self):
 
-        for file_name, ndjson_file_handle in self.poisonous_animals.flowerpot.file_handles():
-            self.log(f"Sending {file_name} to BigQuery")
-            self.animals_database.write_truncate_file(ndjson_file_handle)
-            ndjson_file_handle.close()
+        def ndjson_file_handles():
+            for file_name, ndjson_file_handle in self.poisonous_animals.flowerpot.file_handles():
+                self.log(f"Sending {file_name} to BigQuery")
+                yield ndjson_file_handle
 
-        self.log("All done!")
+        # replaces the table's contents with all the files, loaded concurrently
+        jobs = self.animals_database.transfer_files(ndjson_file_handles())
+        self.log(f"All done! {len(jobs)} files loaded")
 
 if __name__ == '__main__':
     m = FlowerpotToBigquery()
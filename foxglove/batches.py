@@ -0,0 +1,86 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+Column oriented batches of records. See :method:`foxglove.connectors.base.DataConnector.batches`
+
+Needs the optional numpy package for the 'numpy' format and pyarrow for the 'arrow' format.
+They are imported when first used.
+"""
+from importlib import import_module
+from itertools import islice
+from typing import Generator, Iterable, List
+
+BATCH_FORMATS = ('numpy', 'arrow')
+
+
+def _import(package):
+    try:
+        return import_module(package)
+    except ImportError:
+        raise ImportError(f"The {package} package is needed for batches in that format")
+
+
+def check_batch_format(batch_format):
+    if batch_format not in BATCH_FORMATS:
+        raise ValueError(f"Unknown batch format: {batch_format}")
+    _import('numpy' if batch_format == 'numpy' else 'pyarrow')
+
+
+def rows_to_batches(rows: Iterable[dict], batch_size, columns=None,
+                    batch_format='numpy') -> Generator:
+    """
+    Generator yielding batches of at most `batch_size` rows.
+    Args:
+        rows: (iterable of dict)
+        columns: (list of str) optional, default is every field found in the batch's rows.
+        batch_format: (str) 'numpy' for a dict of column name -> numpy array or 'arrow' for a
+                :class:`pyarrow.RecordBatch`
+    """
+    check_batch_format(batch_format)
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        batch_columns = columns or _all_fields(batch)
+        values = {c: [row.get(c) for row in batch] for c in batch_columns}
+        if batch_format == 'arrow':
+            yield _import('pyarrow').RecordBatch.from_pydict(values)
+        else:
+            yield {c: to_numpy_array(v) for c, v in values.items()}
+
+
+def arrow_to_numpy(record_batch) -> dict:
+    """
+    :param record_batch: (:class:`pyarrow.RecordBatch`)
+    :returns: (dict) column name -> numpy array
+    """
+    return {name: column.to_numpy(zero_copy_only=False)
+            for name, column in zip(record_batch.schema.names, record_batch.columns)}
+
+
+def to_numpy_array(values: List):
+    """
+    numpy array with numpy's choice of dtype or, when that isn't possible, e.g. lists of
+    different lengths, an array of python objects.
+    """
+    numpy = _import('numpy')
+    try:
+        array = numpy.array(values)
+        if array.ndim == 1:
+            return array
+    except ValueError:
+        pass
+    array = numpy.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        array[i] = v
+    return array
+
+
+def _all_fields(rows) -> List[str]:
+    fields = {}
+    for row in rows:
+        for k in row:
+            fields.setdefault(k, None)
+    return list(fields)
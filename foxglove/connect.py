@@ -7,6 +7,7 @@ Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 from foxglove.connectors.bigquery import BigQueryConnector
 from foxglove.connectors.fake import FakeDataConnector
 from foxglove.connectors.flowerpot import FlowerPotConnector
+from foxglove.connectors.gcs_flowerpot import GcsFlowerpotConnector
 from foxglove.connectors.kafka_connector import KafkaConnector
 
 
@@ -65,7 +66,7 @@ class Connect:
         engine_url = self.relayed_kwargs['engine_url']
         engine_type = engine_url.split('://', 1)[0] + '://'
         for connector_cls in [BigQueryConnector, FlowerPotConnector, FakeDataConnector,
-                              KafkaConnector]:
+                              GcsFlowerpotConnector, KafkaConnector]:
             if engine_type == connector_cls.engine_type:
                 connector = connector_cls(**self.relayed_kwargs)
                 break
@@ -5,6 +5,11 @@ Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 """
 from abc import ABC, abstractmethod
 from enum import Enum
+from typing import Generator
+
+from foxglove.batches import rows_to_batches
+from foxglove.json_codec import get_codec
+from foxglove.records import RecordDecoder, RecordType
 
 
 class AccessMode(Enum):
@@ -16,12 +21,20 @@ class DataConnector(ABC):
     engine_type = None  # must be defined by subclasses
     optional_args = {}  # subclasses should specify their optional kwargs. Values in this dict are default values.
 
-    def __init__(self, engine_url=None, access=AccessMode.READ, **kwargs):
+    def __init__(self, engine_url=None, access=AccessMode.READ, json_backend=None,
+                 record_type=RecordType.PINNATE, record_fields=None, columns=None, **kwargs):
         """
         API to interact with Foxglove-compatible data sources
         :param engine_url (string): The file or URI to the location of the dataset
         :param access (AccessMode): Whether the dataset accessed through this Connector is for
                 input or output
+        :param json_backend (str): Library used by connectors that (de)serialize JSON.
+                @see :func:`foxglove.json_codec.get_codec`. Default is the standard library.
+        :param record_type (RecordType or str): What connectors that deserialize records yield
+                for each record. Default is :class:`foxglove.pinnate.Pinnate`.
+        :param record_fields (list of str): Fields, in order, for RecordType.TUPLE records
+        :param columns (list of str): Only keep these top level fields of each record. Applies
+                to the same connectors as record_type.
         **kwargs are any params needed by subclasses
 
         Note that subclasses must call this constructor and should 'pop' their arguments so that none are left
@@ -29,6 +42,9 @@ class DataConnector(ABC):
         """
         self.access = access
         self.engine_url = engine_url
+        self.codec = get_codec(json_backend)
+        self.decoder = RecordDecoder(self.codec, record_type=record_type, fields=record_fields,
+                                     columns=columns)
         assert self.engine_url.startswith(self.engine_type)
 
         # process optional arguments with their defaults
@@ -45,6 +61,16 @@ class DataConnector(ABC):
         to be cached by subclasses"""
         pass
 
+    def prefetch(self) -> bool:
+        """
+        Get the data ready to be read, e.g. download it, so that reading it later is quick.
+        Called by :method:`foxglove.model.Model.go` in a thread, alongside other datasets, when
+        the model asks for prefetching. Connectors to remote data that is fetched in full
+        before it can be read override this.
+        :returns: (bool) True if anything was fetched. The default does nothing.
+        """
+        return False
+
     @abstractmethod
     def __len__(self):
         raise NotImplementedError("TODO")
@@ -64,6 +90,31 @@ class DataConnector(ABC):
         self.connect()
         return self.data
 
+    def batches(self, batch_size=10000, columns=None, batch_format='numpy') -> Generator:
+        """
+        Generator yielding column oriented batches of the data for vectorised processing.
+        e.g.
+        ...
+        for batch in self.my_dataset.batches(columns=['name', 'legs']):
+            total_legs += batch['legs'].sum()
+
+        Args:
+            batch_size: (int) maximum number of rows in each batch
+            columns: (list of str) optional, default is all fields found in each batch
+            batch_format: (str) 'numpy' for a dict of column name -> numpy array or 'arrow' for
+                    a :class:`pyarrow.RecordBatch`
+        """
+        yield from rows_to_batches(self._batch_rows(columns), batch_size, columns=columns,
+                                   batch_format=batch_format)
+
+    def _batch_rows(self, columns=None) -> Generator[dict, None, None]:
+        """
+        Rows, as dicts, for :method:`batches`. Subclasses supporting batches implement this.
+        Args:
+            columns: (list of str) optional, rows need only have these fields
+        """
+        raise NotImplementedError("Batches aren't available for this connector")
+
     @property
     @abstractmethod
     def data(self):
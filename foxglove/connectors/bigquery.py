@@ -3,16 +3,36 @@
 Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import gzip
+from importlib import import_module
+import io
+import json
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from typing import Generator
+
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 
+from foxglove.batches import arrow_to_numpy, check_batch_format
 from foxglove.connectors.base import AccessMode, DataConnector
+from foxglove.pinnate import Pinnate
 
 
 class BigQueryConnector(DataConnector):
     engine_type = 'bigquery://'
 
-    optional_args = {'credentials': None, 'auto_schema': False}
+    optional_args = {'credentials': None, 'auto_schema': False, 'write_max_rows': 1000,
+                     'write_max_bytes': 5000000, 'write_max_in_flight': 4,
+                     'write_max_retries': 3, 'write_retry_delay_s': 1.0,
+                     'dead_letter_file': None, 'load_chunk_bytes': 100000000,
+                     'load_max_in_flight': 4, 'read_api': False, 'read_streams': 4}
+    # insert errors for a row that won't succeed if it's sent again
+    permanent_error_reasons = {'invalid', 'invalidQuery', 'notFound', 'accessDenied'}
 
     def __init__(self, *args, **kwargs):
         """
@@ -23,6 +43,27 @@ class BigQueryConnector(DataConnector):
          'credentials' : (dict) for access within Google Cloud Platform
          'auto_schema' : (bool) only needed for streaming data (e.g. :method:`add`) and only
                          when table doesn't already exist.
+         'write_max_rows' : (int) rows from :method:`add` are sent in batches of at most this
+                         many rows
+         'write_max_bytes' : (int) or this many bytes, approximately. BigQuery limits the size
+                         of each streaming insert request to 10MB.
+         'write_max_in_flight' : (int) batches are sent in background threads, at most this
+                         many at a time. :method:`add` waits when this many are being sent.
+                         0 to send in the calling thread.
+         'write_max_retries' : (int) rows that BigQuery didn't insert, other than invalid rows,
+                         are sent again up to this many times. Just the failed rows are sent.
+         'write_retry_delay_s' : (float) wait before the first retry, doubled for each retry
+         'dead_letter_file' : (str) path of ndjson file that rows which couldn't be inserted
+                         are appended to, with their errors. Without it they are kept in
+                         :attr:`failed_rows`.
+         'load_chunk_bytes' : (int) :method:`write_rows` sends a load job for about this many
+                         bytes of ndjson, before compression.
+         'load_max_in_flight' : (int) load jobs run concurrently, at most this many at a time
+         'read_api' : (bool) read with the BigQuery Storage Read API, which is much faster
+                         than paging through results for big tables. Needs the optional
+                         google-cloud-bigquery-storage package, without it pages are read
+                         as usual.
+         'read_streams' : (int) most streams the Storage Read API reads from in parallel
 
         Connection information-
             engine_url format is bigquery://projectId=<projectId>;datasetId=<datasetId>;[tableId=<table>;]
@@ -43,14 +84,21 @@ class BigQueryConnector(DataConnector):
         # set by :method:`connect`
         self.project_id = self.dataset_id = self.table_id = None
         self.client = None
+        self.read_client = None # Storage Read API, see :method:`_read_client`
 
         # these are loaded and created on demand, use via corresponding methods
         self._dataset = self._table_ref = None
 
         # other
-        self.write_buffer_len = 1000 # optimum value not tested for, just guessed
+        self.write_buffer_len = self.write_max_rows
         self.write_rows_buffer = []
+        self._write_buffer_bytes = 0
         self.table_connection = None # different from _table_ref, loaded when needed
+        self._write_executor = None # made when first needed
+        self._writes_in_flight = set() # of :class:`Future`
+        self.write_stats = {'sent': 0, 'retried': 0, 'failed': 0} # rows, see :method:`add`
+        self.failed_rows = [] # (row, errors) when there isn't a 'dead_letter_file'
+        self._write_stats_lock = threading.Lock()
 
     def connect(self):
         if self.client is None:
@@ -79,13 +127,114 @@ class BigQueryConnector(DataConnector):
             ndjson_fh (handle in fileIO type object)
         """
         self.connect()
-        job = self.client.load_table_from_file(
-            file_obj=ndjson_fh,
-            destination=self.table_ref,
-            job_config=self._get_ndjson_load_job_config(append_mode=False)
-        )
-        # wait for it to finish loading
-        job.result()
+        self._load_file(ndjson_fh, append=False)
+
+    def transfer_files(self, file_handles, append=False):
+        """
+        Send the contents of many line delimited JSON files to a bigquery table. The load jobs
+        run concurrently so this takes about as long as the slowest rather than all of them.
+
+        Each file is copied to a temporary file, in this thread and in order, before its job is
+        submitted, then closed. So handles that share an underlying file, e.g. files within a
+        flowerpot, can be given:
+        `connector.transfer_files(fh for _, fh in flowerpot.file_handles())`
+
+        Args:
+            file_handles (iterable of handles in fileIO type object) read lazily
+            append (bool) if False the first file truncates the table, the rest are appended
+                          once it has loaded.
+        Returns:
+            list of finished :class:`bigquery.LoadJob`
+        """
+        return self._load_files(_spool(file_handles), append=append, close=True)
+
+    def write_rows(self, rows, append=False):
+        """
+        Send rows to the bigquery table with load jobs. Much faster and cheaper than
+        streaming inserts (:method:`add`) for a lot of data.
+
+        Rows are serialised to gzipped ndjson chunks as they are read from `rows` and
+        the chunks are loaded concurrently.
+
+        Args:
+            rows (iterable of dict or :class:`Pinnate`) e.g. another connector's `data`
+            append (bool) if False the first chunk truncates the table, the rest are appended
+                          once it has loaded.
+        Returns:
+            list of finished :class:`bigquery.LoadJob`
+        """
+        return self._load_files(self._ndjson_chunks(rows), append=append, close=True)
+
+    def _ndjson_chunks(self, rows) -> Generator:
+        """
+        :returns: generator of gzipped ndjson file objects, each of about 'load_chunk_bytes'
+                  before compression
+        """
+        chunk = None
+        for row in rows:
+            if chunk is None:
+                chunk = io.BytesIO()
+                gzip_file = gzip.GzipFile(fileobj=chunk, mode='wb')
+                chunk_bytes = 0
+            if isinstance(row, Pinnate):
+                row = row.as_dict()
+            line = (self.codec.dumps(row) + '\n').encode('utf-8')
+            gzip_file.write(line)
+            chunk_bytes += len(line)
+            if chunk_bytes >= self.load_chunk_bytes:
+                gzip_file.close()
+                chunk.seek(0)
+                yield chunk
+                chunk = None
+
+        if chunk is not None:
+            gzip_file.close()
+            chunk.seek(0)
+            yield chunk
+
+    def _load_files(self, file_objects, append, close=False):
+        """
+        Load each file into the table, at most 'load_max_in_flight' at a time.
+        :param file_objects: (iterable) ndjson, can be gzipped. Read lazily so only the files
+                    being loaded need to be in memory.
+        :param append: (bool) if False the first file truncates the table and the others are
+                    loaded after it.
+        :param close: (bool) close each file once it's loaded
+        :returns: list of finished :class:`bigquery.LoadJob`
+        """
+        self.connect()
+        file_objects = iter(file_objects)
+        jobs = []
+        if not append:
+            first = next(file_objects, None)
+            if first is None:
+                return jobs
+            # appending while the table is truncated would lose rows
+            jobs.append(self._load_file(first, append=False, close=close))
+
+        with ThreadPoolExecutor(max_workers=self.load_max_in_flight) as executor:
+            in_flight = set()
+            for file_object in file_objects:
+                if len(in_flight) >= self.load_max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    jobs.extend(f.result() for f in done)
+                in_flight.add(executor.submit(self._load_file, file_object, True, close))
+            jobs.extend(f.result() for f in wait(in_flight).done)
+        return jobs
+
+    def _load_file(self, file_object, append, close=False):
+        try:
+            job = self.client.load_table_from_file(
+                file_obj=file_object,
+                destination=self.table_ref,
+                job_config=self._get_ndjson_load_job_config(append_mode=append)
+            )
+            # wait for it to finish loading
+            job.result()
+        finally:
+            if close:
+                file_object.close()
+        return job
 
     def schema(self):
         raise NotImplementedError("TODO")
@@ -143,8 +292,74 @@ class BigQueryConnector(DataConnector):
         TODO slices
         """
         self.connect()
-        full_qual_table = f'{self.project_id}.{self.dataset_id}.{self.table_id}'
-        yield from self.client.list_rows(full_qual_table)
+        read_client = self._read_client()
+        if read_client is None:
+            yield from self.client.list_rows(self.full_qual_table)
+            return
+        for record_batch in self._storage_batches(read_client):
+            yield from _arrow_rows(record_batch)
+
+    @property
+    def full_qual_table(self):
+        return f'{self.project_id}.{self.dataset_id}.{self.table_id}'
+
+    def batches(self, batch_size=10000, columns=None, batch_format='numpy') -> Generator:
+        """
+        @see :method:`foxglove.connectors.base.DataConnector.batches`
+        Each batch is a page of results, converted by the bigquery library to Arrow. With
+        'read_api' pages are sized by BigQuery and `batch_size` is ignored.
+        """
+        check_batch_format(batch_format)
+        self.connect()
+        read_client = self._read_client()
+        if read_client is not None:
+            for record_batch in self._storage_batches(read_client, columns=columns):
+                yield record_batch if batch_format == 'arrow' else arrow_to_numpy(record_batch)
+            return
+
+        selected_fields = None
+        if columns:
+            table = self.client.get_table(self.full_qual_table)
+            selected_fields = [f for f in table.schema if f.name in columns]
+        rows = self.client.list_rows(self.full_qual_table, selected_fields=selected_fields,
+                                     page_size=batch_size)
+        for record_batch in rows.to_arrow_iterable():
+            yield record_batch if batch_format == 'arrow' else arrow_to_numpy(record_batch)
+
+    def _read_client(self):
+        """
+        :returns: Storage Read API client or None when 'read_api' isn't set or the
+                  google-cloud-bigquery-storage package isn't installed.
+        """
+        if not self.read_api:
+            return None
+        if self.read_client is None:
+            bigquery_storage = _bigquery_storage()
+            if bigquery_storage is None:
+                return None
+            self.read_client = bigquery_storage.BigQueryReadClient(credentials=self.credentials)
+        return self.read_client
+
+    def _storage_batches(self, read_client, columns=None) -> Generator:
+        """
+        Read the table with the Storage Read API. Streams are read in parallel, in background
+        threads, so batches from different streams are interleaved.
+        :param columns: (list of str) optional, default is all columns
+        :returns: generator of :class:`pyarrow.RecordBatch`
+        """
+        types = _bigquery_storage().types
+        requested_session = types.ReadSession(
+            table=f"projects/{self.project_id}/datasets/{self.dataset_id}/tables/{self.table_id}",
+            data_format=types.DataFormat.ARROW,
+            read_options=types.ReadSession.TableReadOptions(selected_fields=list(columns or []))
+        )
+        session = read_client.create_read_session(parent=f"projects/{self.project_id}",
+                                                  read_session=requested_session,
+                                                  max_stream_count=self.read_streams)
+        if not session.streams:
+            # empty table
+            return
+        yield from _read_streams(read_client, session)
 
     def __len__(self):
         raise NotImplementedError("TODO")
@@ -161,12 +376,15 @@ class BigQueryConnector(DataConnector):
             row (dict) or tuple with correct column mappings
         """
         self.write_rows_buffer.append(row)
-        if len(self.write_rows_buffer) >= self.write_buffer_len:
-            self.flush_writes()
+        self._write_buffer_bytes += _approximate_size(row)
+        if len(self.write_rows_buffer) >= self.write_buffer_len \
+                or self._write_buffer_bytes >= self.write_max_bytes:
+            self._send_write_buffer()
 
     def flush_writes(self):
         """
-        Write any buffered data to BigQuery.
+        Write any buffered data to BigQuery and wait for all batches being sent to finish.
+        Errors from sending any batch are raised here, or by :method:`add`.
 
         Note that streaming data is treated slightly differently than file loads.
         See
@@ -177,12 +395,58 @@ class BigQueryConnector(DataConnector):
         statistics' section of the table's details section.
         These data does show up in queries but not preview.
         """
+        self._send_write_buffer()
+        self._wait_for_writes(0)
+
+    def _send_write_buffer(self):
+        """
+        Send the buffered rows in a background thread, waiting if too many are being sent.
+        """
         if len(self.write_rows_buffer) == 0:
             # nothing to do
             return
 
         self.connect()
+        table = self._write_table()
+        if self.write_max_in_flight:
+            # before taking the buffered rows so they are kept if an earlier batch failed
+            self._wait_for_writes(self.write_max_in_flight - 1)
+
+        rows = self.write_rows_buffer
+        self.write_rows_buffer = []
+        self._write_buffer_bytes = 0
+
+        if not self.write_max_in_flight:
+            self._insert_rows(table, rows)
+            return
 
+        if self._write_executor is None:
+            self._write_executor = ThreadPoolExecutor(max_workers=self.write_max_in_flight)
+        self._writes_in_flight.add(self._write_executor.submit(self._insert_rows, table, rows))
+
+    def _wait_for_writes(self, max_in_flight):
+        """
+        Wait until no more than `max_in_flight` batches are being sent. Raises the error from
+        a finished batch or, when several failed, a ValueError listing them all.
+        """
+        done = {f for f in self._writes_in_flight if f.done()}
+        while len(self._writes_in_flight) - len(done) > max_in_flight:
+            finished, _ = wait(self._writes_in_flight - done, return_when=FIRST_COMPLETED)
+            done |= finished
+
+        self._writes_in_flight -= done
+        errors = [f.exception() for f in done if f.exception() is not None]
+        if len(errors) == 1:
+            # raise exception from thread
+            raise errors[0]
+        if errors:
+            messages = '; '.join(f"{type(e).__name__}: {e}" for e in errors)
+            raise ValueError(f"{len(errors)} batches failed to send- {messages}") from errors[0]
+
+    def _write_table(self):
+        """
+        :returns: :class:`bigquery.Table` for :method:`add`, created if needed
+        """
         if self.table_connection is None:
             # create when needed
 
@@ -196,11 +460,51 @@ class BigQueryConnector(DataConnector):
                 auto_schema = self._auto_schema(self.write_rows_buffer)
                 table = bigquery.Table(self.table_ref, schema=auto_schema)
                 self.table_connection = self.client.create_table(table)
+        return self.table_connection
 
-
-        errors = self.client.insert_rows(self.table_connection, self.write_rows_buffer)
-        # TODO log the errors
-        self.write_rows_buffer = []
+    def _insert_rows(self, table, rows):
+        """
+        Insert rows, retrying those that fail with a temporary error. Rows that can't be
+        inserted go to the dead letter file.
+        """
+        attempt = 0
+        while rows:
+            errors = self.client.insert_rows(table, rows)
+            # list of {'index': position in rows, 'errors': [{'reason': ..., 'message': ...}]}
+            row_errors = {e['index']: e['errors'] for e in errors}
+
+            retry = []
+            failed = []
+            for index, errors_for_row in row_errors.items():
+                permanent = any(e.get('reason') in self.permanent_error_reasons
+                                for e in errors_for_row)
+                if permanent or attempt >= self.write_max_retries:
+                    failed.append((rows[index], errors_for_row))
+                else:
+                    retry.append(rows[index])
+
+            with self._write_stats_lock:
+                self.write_stats['sent'] += len(rows) - len(row_errors)
+                self.write_stats['retried'] += len(retry)
+                self.write_stats['failed'] += len(failed)
+                if failed:
+                    self._dead_letter(failed)
+
+            if retry:
+                time.sleep(self.write_retry_delay_s * 2 ** attempt)
+            rows = retry
+            attempt += 1
+
+    def _dead_letter(self, failed):
+        """
+        :param failed: (list of (row, errors))
+        """
+        if self.dead_letter_file is None:
+            self.failed_rows.extend(failed)
+            return
+        with open(self.dead_letter_file, 'a') as f:
+            for row, errors in failed:
+                f.write(json.dumps({'row': row, 'errors': errors}, default=str) + '\n')
 
     def _auto_schema(self, sample_data):
         """
@@ -250,4 +554,109 @@ class BigQueryConnector(DataConnector):
         if sql_params:
             job_config.query_parameters = [bigquery.ScalarQueryParameter(*sp) for sp in sql_params]
         query_job = self.client.query(sql, job_config=job_config)
-        yield from query_job
+        read_client = self._read_client()
+        if read_client is None:
+            yield from query_job
+            return
+        # the bigquery library reads the query's results table with the Storage Read API
+        for record_batch in query_job.result().to_arrow_iterable(bqstorage_client=read_client):
+            yield from _arrow_rows(record_batch)
+
+
+def _approximate_size(row) -> int:
+    """
+    Rough size in bytes of a row once serialized for sending. Good enough for batching.
+    """
+    if isinstance(row, dict):
+        return sum(len(str(k)) + len(str(v)) + 6 for k, v in row.items())
+    return sum(len(str(v)) + 3 for v in row)
+
+
+# files bigger than this are spooled to disk rather than kept in memory
+_SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+
+def _spool(file_handles) -> Generator:
+    """
+    :returns: generator of temporary files with the contents of each file, which is closed.
+              Small files are kept in memory.
+    """
+    for file_handle in file_handles:
+        spooled = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_BYTES)
+        try:
+            with file_handle:
+                shutil.copyfileobj(file_handle, spooled)
+            spooled.seek(0)
+        except BaseException:
+            spooled.close()
+            raise
+        yield spooled
+
+
+def _bigquery_storage():
+    """
+    :returns: google.cloud.bigquery_storage module or None if it isn't installed
+    """
+    try:
+        return import_module('google.cloud.bigquery_storage')
+    except ImportError:
+        return None
+
+
+def _arrow_rows(record_batch) -> Generator:
+    """
+    :returns: generator of :class:`bigquery.Row`, like those from paging through results
+    """
+    field_to_index = {name: i for i, name in enumerate(record_batch.schema.names)}
+    for values in zip(*(column.to_pylist() for column in record_batch.columns)):
+        yield bigquery.Row(values, field_to_index)
+
+
+_STREAM_DONE = object()
+
+
+def _read_streams(read_client, session) -> Generator:
+    """
+    Read every stream in a Storage Read API session, each in a background thread.
+    :returns: generator of :class:`pyarrow.RecordBatch` in the order they are read
+    """
+    # bounded so readers don't get far ahead of the consumer
+    batches = queue.Queue(maxsize=2 * len(session.streams))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_stream(stream):
+        try:
+            for page in read_client.read_rows(stream.name).rows(session).pages:
+                if not put(page.to_arrow()):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(_STREAM_DONE)
+
+    for stream in session.streams:
+        threading.Thread(target=read_stream, args=(stream,), daemon=True).start()
+
+    try:
+        finished = 0
+        while finished < len(session.streams):
+            item = batches.get()
+            if item is _STREAM_DONE:
+                finished += 1
+            elif isinstance(item, Exception):
+                # raise exception from thread
+                raise item
+            else:
+                yield item
+    finally:
+        # readers stop if this generator is closed early
+        stop.set()
@@ -0,0 +1,65 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+import hashlib
+import os
+
+
+def cache_key(*parts) -> str:
+    """
+    :returns: (str) file name safe digest of all the parts
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def touch(path):
+    """
+    Mark a cache file as recently used. Modification time is used, rather than access time,
+    because many filesystems are mounted with noatime.
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        # evicted by another process
+        pass
+
+
+def evict_least_recently_used(cache_dir, max_bytes, suffix=''):
+    """
+    Delete the least recently used files in `cache_dir` until their total size is no more than
+    `max_bytes`.
+    Args:
+        suffix: (str) only files with names ending with this are considered.
+    Returns:
+        (list of str) paths of deleted files
+    """
+    entries = []
+    total_bytes = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file() or not entry.name.endswith(suffix):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes += stat.st_size
+
+    deleted = []
+    entries.sort()
+    for _, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_bytes -= size
+        deleted.append(path)
+    return deleted
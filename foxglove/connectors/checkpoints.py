@@ -0,0 +1,58 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+from datetime import datetime, timezone
+import sqlite3
+from typing import Dict
+
+
+class SqliteCheckpointStore:
+    """
+    Record how far a reader has got through each partition of a topic so the next read can
+    carry on from there. Offsets stored are of the next message to read.
+
+    >>> store = SqliteCheckpointStore(':memory:')
+    >>> store.save('daily_model', 'foobar', {0: 101, 1: 57})
+    >>> store.load('daily_model', 'foobar')
+    {0: 101, 1: 57}
+
+    A checkpoint is identified by a name, e.g. a model or a consumer group, and a topic. Saving
+    updates just the partitions given. Each save is a transaction so several processes can
+    share a file.
+    """
+    def __init__(self, path):
+        """
+        :param path: (str) SQLite database file, created if needed
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS checkpoints ("
+                                     "name TEXT, topic TEXT, partition INTEGER, "
+                                     "next_offset INTEGER, updated TEXT, "
+                                     "PRIMARY KEY (name, topic, partition))")
+
+    def load(self, name, topic) -> Dict[int, int]:
+        """
+        :returns: (dict) partition -> offset of next message to read. Empty if there isn't a
+                  checkpoint.
+        """
+        rows = self._connection.execute("SELECT partition, next_offset FROM checkpoints "
+                                        "WHERE name = ? AND topic = ?", (name, topic))
+        return dict(rows.fetchall())
+
+    def save(self, name, topic, offsets: Dict[int, int]):
+        """
+        :param offsets: (dict) partition -> offset of next message to read
+        """
+        updated = datetime.now(timezone.utc).isoformat()
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO checkpoints "
+                                         "VALUES (?, ?, ?, ?, ?)",
+                                         [(name, topic, partition, offset, updated)
+                                          for partition, offset in offsets.items()])
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,141 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+from contextlib import contextmanager
+import os
+import threading
+
+from foxglove.connectors.cache_utils import cache_key, evict_least_recently_used, touch
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows. Downloads are still written atomically but concurrent
+    # processes may download the same object.
+    fcntl = None
+
+
+class DownloadCache:
+    """
+    On disk cache of objects downloaded from remote storage, e.g. flowerpots in Google Cloud
+    Storage, so consecutive runs on the same host don't download them again.
+
+    Objects are keyed by their location and version, e.g. bucket, path and generation, so a
+    changed object is downloaded again. Processes sharing a cache directory take a lock per
+    object so each object is downloaded once.
+
+    `hits` and `misses` count lookups by this instance. Use :func:`download_cache` to share an
+    instance, and its counters, between connectors.
+    """
+    suffix = '.download'
+    # Lock files are empty and never deleted. Another process may hold, or be waiting for, a
+    # lock on one so deleting it would let a third process take a lock on a new file.
+    lock_suffix = '.lock'
+    # files kept next to a cached object, deleted with it. e.g. a flowerpot index
+    sidecar_suffixes = ('.index',)
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        :param cache_dir: (str) directory for cached objects, created if needed
+        :param max_bytes: (int) optional, least recently used objects are deleted to keep the
+                total size of cached objects below this.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _path(self, *key_parts) -> str:
+        return os.path.join(self.cache_dir, cache_key(*key_parts) + self.suffix)
+
+    def _count(self, hit):
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @contextmanager
+    def _lock(self, path):
+        if fcntl is None:
+            yield
+            return
+        with open(path + self.lock_suffix, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fetch(self, key_parts, download) -> str:
+        """
+        Path to a cached object, downloading it first if it isn't cached.
+        Args:
+            key_parts: (tuple) identify the object and its version
+            download: (callable) given a binary file handle, writes the object to it
+        Returns:
+            (str) path to local copy of the object
+        """
+        path = self._path(*key_parts)
+        if os.path.exists(path):
+            self._count(hit=True)
+            touch(path)
+            return path
+
+        with self._lock(path):
+            # another process may have downloaded it while this one waited for the lock
+            if os.path.exists(path):
+                self._count(hit=True)
+                touch(path)
+                return path
+
+            self._count(hit=False)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_path, 'wb') as f:
+                    download(f)
+                if self.max_bytes is not None:
+                    # make room before adding so the new object isn't the one evicted
+                    self._evict(self.max_bytes - os.path.getsize(temp_path))
+                # atomic so concurrent readers never see a partial object
+                os.replace(temp_path, path)
+            except BaseException:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+        return path
+
+    def _evict(self, max_bytes):
+        for deleted in evict_least_recently_used(self.cache_dir, max(max_bytes, 0),
+                                                 suffix=self.suffix):
+            for sidecar_suffix in self.sidecar_suffixes:
+                try:
+                    os.remove(deleted + sidecar_suffix)
+                except OSError:
+                    pass
+
+
+_caches = {} # key is (cache_dir, max_bytes)
+_caches_lock = threading.Lock()
+
+
+def download_cache(cache_dir, max_bytes=None) -> DownloadCache:
+    """
+    :returns: :class:`DownloadCache` shared by everything in this process using the same
+              `cache_dir` and `max_bytes`.
+    """
+    key = (os.path.abspath(cache_dir), max_bytes)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = DownloadCache(cache_dir, max_bytes=max_bytes)
+        return _caches[key]
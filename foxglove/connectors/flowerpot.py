@@ -3,42 +3,216 @@
 Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import json
+import os
 import tarfile
 from typing import Generator, List
 
-import ndjson
-
+from foxglove.batches import arrow_to_numpy, check_batch_format, rows_to_batches
 from foxglove.connectors.base import DataConnector
+from foxglove.connectors.flowerpot_cache import ColumnarCache, select_columns, table_rows
+from foxglove.json_codec import get_codec
 from foxglove.pinnate import Pinnate
+from foxglove.records import RecordDecoder, RecordType
+
+
+class FlowerpotIndex:
+    """
+    Location, size and number of records for each file within a flowerpot tarball.
+
+    Listing the files in a gzipped tarball means decompressing all of it so the index is
+    built once and stored next to the flowerpot in a sidecar file (<flowerpot>.index). It's
+    rebuilt when the flowerpot's size or modification time changes.
+    """
+    index_suffix = '.index'
+    version = 1
+
+    def __init__(self, files, source_size=None, source_mtime=None):
+        """
+        :param files: (list of dict) with 'name', 'offset', 'size' and 'records' keys. 'offset'
+                and 'size' are the position of the file's data within the uncompressed tarball.
+        :param source_size: (int) size in bytes of the flowerpot this index describes
+        :param source_mtime: (float) modification time of the flowerpot this index describes
+        """
+        self.files = files
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self._by_name = {f['name']: f for f in files}
+
+    @classmethod
+    def build(cls, tar_file) -> 'FlowerpotIndex':
+        """
+        Scan every file in an open tarball. This reads the tarball sequentially, once.
+        """
+        files = []
+        for tar_info in tar_file:
+            if not tar_info.isfile():
+                continue
+            with tar_file.extractfile(tar_info) as f:
+                records = sum(1 for line in f if not line.isspace())
+            files.append({'name': tar_info.name,
+                          'offset': tar_info.offset_data,
+                          'size': tar_info.size,
+                          'records': records,
+                          })
+        return cls(files)
+
+    @classmethod
+    def for_filename(cls, filename) -> 'FlowerpotIndex':
+        """
+        Load the sidecar index for a flowerpot file or build, and try to save, it if it
+        doesn't exist or is out of date.
+        """
+        stat = os.stat(filename)
+        index_filename = filename + cls.index_suffix
+        try:
+            with open(index_filename) as f:
+                doc = json.load(f)
+            if doc['version'] == cls.version and doc['source_size'] == stat.st_size \
+                    and doc['source_mtime'] == stat.st_mtime:
+                return cls(doc['files'], doc['source_size'], doc['source_mtime'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with tarfile.open(filename, mode='r:gz') as tf:
+            index = cls.build(tf)
+        index.source_size = stat.st_size
+        index.source_mtime = stat.st_mtime
+        index.save(index_filename)
+        return index
+
+    def save(self, index_filename):
+        """
+        Write index as JSON. Failing to write, e.g. a read only directory, isn't an error as
+        the index is still usable from memory.
+        """
+        doc = {'version': self.version,
+               'source_size': self.source_size,
+               'source_mtime': self.source_mtime,
+               'files': self.files,
+               }
+        temp_filename = f"{index_filename}.{os.getpid()}.tmp"
+        try:
+            with open(temp_filename, 'w') as f:
+                json.dump(doc, f)
+            # atomic so concurrent readers never see a partial index
+            os.replace(temp_filename, index_filename)
+        except OSError:
+            pass
+
+    @property
+    def file_names(self) -> List[str]:
+        return [f['name'] for f in self.files]
+
+    def tar_info(self, file_name) -> tarfile.TarInfo:
+        """
+        :returns: :class:`tarfile.TarInfo` that can be given to :method:`TarFile.extractfile`
+                  without :class:`TarFile` scanning the tarball to find it.
+        """
+        details = self._by_name[file_name]
+        tar_info = tarfile.TarInfo(name=file_name)
+        tar_info.offset_data = details['offset']
+        tar_info.size = details['size']
+        return tar_info
+
+    def records(self, file_name) -> int:
+        return self._by_name[file_name]['records']
 
 
 class FlowerpotEngine:
     """File-access Interface to Datalab 'Flowerpot' style ND-JSON tarballs."""
 
-    def __init__(self, tar_file):
+    def __init__(self, tar_file, index=None, filename=None, codec=None, stream=False):
+        """
+        :param tar_file: (:class:`tarfile.TarFile`)
+        :param index: (:class:`FlowerpotIndex`) optional, without it files are found by
+                scanning the tarball.
+        :param filename: (str) optional, path to the tarball. Needed for a columnar cache.
+        :param codec: (:class:`foxglove.json_codec.JsonCodec`) optional, default is the standard
+                library. @see :func:`foxglove.json_codec.get_codec`
+        :param stream: (bool) `tar_file` was opened in stream mode ('r|gz') so can only be read
+                once, in order. @see :method:`from_stream`
+        """
         self._tar_file = tar_file
+        self._index = index
+        self._filename = filename
+        self._codec = codec or get_codec()
+        self._stream = stream
 
     @staticmethod
-    def from_filename(filename) -> 'LazyFlowerpotReader':
+    def from_filename(filename, use_index=True, codec=None) -> 'LazyFlowerpotReader':
+        """
+        :param use_index: (bool) load, or build and save, a :class:`FlowerpotIndex` for the file
+        """
+        index = FlowerpotIndex.for_filename(filename) if use_index else None
         tf = tarfile.open(filename, mode='r:gz')
-        return FlowerpotEngine(tf)
+        return FlowerpotEngine(tf, index=index, filename=filename, codec=codec)
 
     @staticmethod
-    def from_file(file_object) -> 'LazyFlowerpotReader':
+    def from_file(file_object, codec=None) -> 'LazyFlowerpotReader':
         tf = tarfile.open(fileobj=file_object, mode='r:gz')
-        return FlowerpotEngine(tf)
+        return FlowerpotEngine(tf, codec=codec)
+
+    @staticmethod
+    def from_stream(file_object, codec=None) -> 'LazyFlowerpotReader':
+        """
+        Read a flowerpot from a file object that is only read sequentially, e.g. a download in
+        progress, so items are available as soon as the start of the flowerpot has arrived.
+        There's no seeking so the flowerpot can only be read once, with :method:`items`.
+        """
+        tf = tarfile.open(fileobj=file_object, mode='r|gz')
+        return FlowerpotEngine(tf, codec=codec, stream=True)
 
     @property
     def file_names(self) -> List[str]:
         """Get all filenames contained in a flowerpot tarball"""
+        if self._stream:
+            raise ValueError("File names aren't known until a streamed flowerpot has been read")
+        if self._index is not None:
+            return self._index.file_names
         file_names = [f.name for f in self._tar_file.getmembers() if f.isfile()]
         return file_names
 
-    def _extract_ndjson_to_list(self, filename) -> List[object]:
-        """Deserialize an entire ndjson file to a python list"""
-        with self._tar_file.extractfile(filename) as f:
-            byte_string = f.read()
-            return FlowerpotEngine._deserialize_ndjson_string(byte_string)
+    def _extract(self, filename):
+        """File handle for a file within the flowerpot"""
+        if self._index is not None:
+            return self._tar_file.extractfile(self._index.tar_info(filename))
+        return self._tar_file.extractfile(filename)
+
+    def record_count(self, file_name=None) -> int:
+        """
+        Number of records in file(s) within the flowerpot. Needs an index.
+        Args:
+            file_name: (str or list of str) if not given, all files are counted.
+        """
+        if self._index is None:
+            raise NotImplementedError("Record count is only available for indexed flowerpots")
+        if file_name:
+            selected_files = file_name if isinstance(file_name, list) else [file_name,]
+        else:
+            selected_files = self.file_names
+        return sum(self._index.records(f) for f in selected_files)
+
+    def _ndjson_lines(self, filename, streaming=True) -> Generator[bytes, None, None]:
+        """
+        Generator returning each non-blank line of an ndjson file without the line ending.
+        Args:
+            streaming: (bool) read one line at a time so only the current line is held in
+                        memory. When False the whole file is read first.
+        """
+        with self._extract(filename) as f:
+            yield from self._lines(f, streaming=streaming)
+
+    @staticmethod
+    def _lines(file_handle, streaming=True) -> Generator[bytes, None, None]:
+        """@see :method:`_ndjson_lines`"""
+        lines = file_handle if streaming else file_handle.read().splitlines()
+        for line in lines:
+            # ndjson allows blank lines, e.g. a trailing newline at end of file
+            if line and not line.isspace():
+                yield line.rstrip(b'\r\n')
 
     def file_handles(self) -> Generator[object, None, None]:
         """
@@ -46,54 +220,254 @@ class FlowerpotEngine:
         It's polite for the user of this generator to .close() the file handle.
         """
         for file_name in self.file_names:
-            fh = self._tar_file.extractfile(file_name)
+            fh = self._extract(file_name)
             yield file_name, fh
 
     @staticmethod
-    def _deserialize_ndjson_string(byte_string) -> List[object]:
+    def _deserialize_ndjson_string(byte_string, codec=None) -> List[object]:
         """
         Deserialize the contents of a newline-delimited JSON string to a list
         Args:
             byte_string: The NDJSON contents to be deserialized
+            codec: (:class:`foxglove.json_codec.JsonCodec`) optional
         Returns:
             list: Each individual JSON entry deserialized as Python objects
         """
-        utf8_string = str(byte_string, 'utf-8')
-        content = ndjson.loads(utf8_string)
-        return content
+        codec = codec or get_codec()
+        return [codec.loads(line) for line in byte_string.splitlines() if line.strip()]
 
-    def items(self, file_name=None) -> Generator[object, None, None]:
+    def items(self, file_name=None, streaming=True, processes=None, ordered=True,
+              max_in_flight=None, decoder=None, cache=None) -> Generator[object, None, None]:
         """
         Args:
             file_name: (str or list of str) file(s) within flowerpot if not
                         given, all files will be used.
+            streaming: (bool) deserialize line by line. When False each file is read and
+                        deserialized in full before the first item is yielded.
+            processes: (int) optional, deserialize files in this many worker processes.
+                        The flowerpot is decompressed once, in this process, and each worker
+                        is sent a whole file at a time.
+            ordered: (bool) only used with `processes`. Items are yielded in file order when
+                        True, otherwise in the order files finish.
+            max_in_flight: (int) only used with `processes`. Maximum number of files being read
+                        or waiting to be yielded. Default is twice `processes`.
+            decoder: (:class:`foxglove.records.RecordDecoder`) optional, makes the items
+                        that are yielded. Default is :class:`Pinnate` objects.
+            cache: (:class:`foxglove.connectors.flowerpot_cache.ColumnarCache`) optional,
+                        read files from and add them to this cache. Files are read in this
+                        process, `processes` isn't used. Needs a flowerpot opened by filename.
         Generator returning each json object in a Flowerpot (across all individual files)
+
+        A flowerpot from :method:`from_stream` is read in this process in the order files are
+        stored; `processes` and `cache` aren't used.
+        """
+        decoder = decoder or RecordDecoder(self._codec)
+
+        if self._stream:
+            yield from self._streamed_items(file_name, streaming, decoder)
+            return
+
+        if file_name:
+            selected_files = file_name if isinstance(file_name, list) else [file_name,]
+        else:
+            selected_files = self.file_names
+
+        if cache is not None and self._filename is not None \
+                and decoder.record_type != RecordType.RAW:
+            for file in selected_files:
+                yield from self._cached_items_in_file(file, cache, decoder)
+            return
+
+        if processes and processes > 1:
+            yield from self._parallel_items(selected_files, processes, ordered, max_in_flight,
+                                            decoder)
+            return
+
+        for file in selected_files:
+            yield from self._items_in_file(file, streaming=streaming, decoder=decoder)
+
+    def _parallel_items(self, selected_files, processes, ordered, max_in_flight,
+                        decoder) -> Generator:
+        """
+        Generator returning each json object in `selected_files` made by `decoder`.
+        Files are read in order here, so the tarball is decompressed once, and deserialized in
+        worker processes. At most `max_in_flight` files are being deserialized or waiting to be
+        yielded so memory use is capped at roughly that many files.
+        """
+        # Pinnates are cheap to make so send plain dicts between processes and wrap them here
+        wrap_in_pinnate = decoder.record_type == RecordType.PINNATE
+        if wrap_in_pinnate:
+            decoder = decoder.derive(record_type=RecordType.DICT)
+
+        max_in_flight = max_in_flight or processes * 2
+        files_to_read = iter(selected_files)
+        in_flight = deque()
+
+        def submit_next():
+            file = next(files_to_read, None)
+            if file is None:
+                return False
+            with self._extract(file) as f:
+                ndjson = f.read()
+            in_flight.append(executor.submit(_deserialize_ndjson_file, ndjson, decoder))
+            return True
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            try:
+                while len(in_flight) < max_in_flight and submit_next():
+                    pass
+
+                while in_flight:
+                    if ordered:
+                        done = [in_flight.popleft()]
+                    else:
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            in_flight.remove(future)
+
+                    for future in done:
+                        records = future.result()
+                        submit_next()
+                        if wrap_in_pinnate:
+                            yield from map(Pinnate, records)
+                        else:
+                            yield from records
+            finally:
+                # generator might not have been exhausted
+                for future in in_flight:
+                    future.cancel()
+
+    def _items_in_file(self, file, streaming=True, decoder=None) -> object:
+        """
+        Generator returning each json object in an ndjson file made by `decoder`, default is
+        :class:`Pinnate` form.
+        """
+        decoder = decoder or RecordDecoder(self._codec)
+        yield from decoder.decode_all(self._ndjson_lines(file, streaming=streaming))
+
+    def _streamed_items(self, file_name, streaming, decoder) -> Generator:
+        """
+        Generator like :method:`items` for a flowerpot opened with :method:`from_stream`.
+        Each file is read as it arrives.
         """
+        if file_name:
+            selected_files = set(file_name if isinstance(file_name, list) else [file_name,])
+        else:
+            selected_files = None
+
+        for tar_info in self._tar_file:
+            if not tar_info.isfile():
+                continue
+            if selected_files is not None and tar_info.name not in selected_files:
+                continue
+            with self._tar_file.extractfile(tar_info) as f:
+                yield from decoder.decode_all(self._lines(f, streaming=streaming))
+
+    def _cached_items_in_file(self, file, cache, decoder) -> Generator:
+        """
+        Generator like :method:`_items_in_file` that reads from `cache` or adds the file to
+        `cache`.
+        """
+        table, docs = self._cached_table(file, cache)
+        if table is None:
+            # can't be cached
+            yield from decoder.from_parsed_all(docs)
+            return
+
+        yield from decoder.from_parsed_all(table_rows(table, columns=decoder.needed_columns))
+
+    def _cached_table(self, file, cache):
+        """
+        Get a file from `cache`, adding it first if needed.
+        :returns: (:class:`pyarrow.Table`, None) or (None, list of deserialized records) when
+                  the file can't be cached.
+        """
+        table = cache.get(self._filename, file)
+        if table is not None:
+            return table, None
+        docs = [self._codec.loads(line) for line in self._ndjson_lines(file)]
+        table = cache.put(self._filename, file, docs)
+        return table, None if table is not None else docs
+
+    def cached_batches(self, cache, file_name=None, batch_size=10000, columns=None,
+                       batch_format='numpy') -> Generator:
+        """
+        Generator yielding column oriented batches straight from the columnar cache, without
+        making a python object for each value.
+        Args: @see :method:`items` and :method:`foxglove.connectors.base.DataConnector.batches`
+        Batches don't span files so can be smaller than `batch_size`.
+        """
+        check_batch_format(batch_format)
+        if self._filename is None:
+            raise ValueError("The columnar cache needs a flowerpot opened by filename")
         if file_name:
             selected_files = file_name if isinstance(file_name, list) else [file_name,]
         else:
             selected_files = self.file_names
 
         for file in selected_files:
-            yield from self._items_in_file(file)
+            table, docs = self._cached_table(file, cache)
+            if table is None:
+                yield from rows_to_batches(docs, batch_size, columns=columns,
+                                           batch_format=batch_format)
+                continue
+
+            table = select_columns(table, columns)
+            for record_batch in table.to_batches(max_chunksize=batch_size):
+                yield record_batch if batch_format == 'arrow' else arrow_to_numpy(record_batch)
+
 
-    def _items_in_file(self, file) -> object:
-        """Generator returning each json object in an ndjson file in :class:`Pinnate` form."""
-        for deserialized_json_object in self._extract_ndjson_to_list(file):
-            yield Pinnate(data=deserialized_json_object)
+def _deserialize_ndjson_file(ndjson, decoder) -> List[object]:
+    """
+    Deserialize an entire ndjson file from within a flowerpot. Run in a worker process by
+    :method:`FlowerpotEngine._parallel_items`.
+    Args:
+        ndjson: (bytes) contents of the file
+        decoder: (:class:`foxglove.records.RecordDecoder`)
+    """
+    return list(decoder.decode_all(FlowerpotEngine._lines(ndjson.splitlines(keepends=True))))
 
 
 class FlowerPotConnector(DataConnector):
     engine_type = 'flowerpot://'
+    optional_args = {'streaming': True, 'use_index': True, 'processes': None, 'ordered': True,
+                     'max_in_flight': None, 'cache_dir': None, 'cache_max_bytes': None}
 
     def __init__(self, *args, **kwargs):
+        """
+        Connector to a Datalab 'Flowerpot' on the local filesystem.
+        Args: @see :class:`connectors.base.DataConnector`
+
+        additional args for FlowerPotConnector
+         'streaming' : (bool) deserialize files within the flowerpot line by line so memory use
+                       doesn't grow with file size. Default is True.
+         'use_index' : (bool) keep a :class:`FlowerpotIndex` in a sidecar file next to the
+                       flowerpot so files can be listed and selected without decompressing the
+                       whole flowerpot. Default is True.
+         'processes' : (int) read files within the flowerpot in this many worker processes.
+                       Default is to read them one after another in this process.
+         'ordered' : (bool) with 'processes', keep records in file order. Default is True.
+         'max_in_flight' : (int) with 'processes', maximum number of files being read at once.
+                       @see :method:`FlowerpotEngine.items`
+         'cache_dir' : (str) keep files from the flowerpot in this directory in a columnar
+                       format so they are quicker to read next time. Needs pyarrow.
+                       @see :class:`foxglove.connectors.flowerpot_cache.ColumnarCache`
+         'cache_max_bytes' : (int) with 'cache_dir', least recently used files are removed
+                       from the cache to keep it below this size.
+
+            engine_url format is flowerpot://<file path>
+        """
         super().__init__(*args, **kwargs)
         self._flowerpot = None
+        self._cache = None
 
     def connect(self):
         if self._flowerpot is None:
+            if self.cache_dir is not None:
+                self._cache = ColumnarCache(self.cache_dir, max_bytes=self.cache_max_bytes)
             file_path = self.engine_url.split(self.engine_type)[1]
-            self._flowerpot = FlowerpotEngine.from_filename(file_path)
+            self._flowerpot = FlowerpotEngine.from_filename(file_path, use_index=self.use_index,
+                                                            codec=self.codec)
 
     @property
     def flowerpot(self) -> object:
@@ -102,7 +476,8 @@ class FlowerPotConnector(DataConnector):
         return self._flowerpot
 
     def __len__(self):
-        raise NotImplementedError("TODO")
+        self.connect()
+        return self._flowerpot.record_count()
 
     def __getitem__(self, key):
         raise NotImplementedError("TODO")
@@ -112,13 +487,33 @@ class FlowerPotConnector(DataConnector):
         get a subset of :method:`data`.
         Allowed options-
         table : get rows from all files that start with that string followed by an underscore,
-                followed by a number
+                followed by a number. Default is all files.
+        columns : (list of str) only keep these top level fields in each row. Overrides the
+                connector's 'columns'.
+        where : only get rows matching this filter. It is one of-
+                (dict) field -> value, rows where all fields equal their values
+                (list) of (field, operator, value) tuples e.g. ('legs', '>=', 4) and/or
+                       callables
+                (callable) given the row as a dict, returns True to keep it
+                See :class:`foxglove.records.RecordFilter`. When reading with 'processes',
+                callables must be picklable, i.e. not lambdas.
         """
         table = kwargs.pop('table', None)
-        if not table:
-            raise NotImplementedError("Only 'table' has been implemented.")
+        decoder_settings = {k: kwargs.pop(k) for k in ('columns', 'where') if k in kwargs}
+        # empty is the same as not given
+        decoder_settings = {k: v for k, v in decoder_settings.items() if v}
+        if kwargs:
+            raise NotImplementedError(f"Unknown options: {', '.join(kwargs)}")
 
         self.connect()
+        selected_files = self._table_files(table) if table else None
+        decoder = self.decoder.derive(**decoder_settings) if decoder_settings else self.decoder
+        return self._items(file_name=selected_files, decoder=decoder)
+
+    def _table_files(self, table):
+        """
+        Files within the flowerpot that make up `table`. See :method:`query`.
+        """
         # could use a regex
         selected_files = []
         for file in self._flowerpot.file_names:
@@ -135,12 +530,44 @@ class FlowerPotConnector(DataConnector):
         if len(selected_files) == 0:
             raise ValueError("Table doesn't exist")
 
-        return self._flowerpot.items(file_name=selected_files)
+        return selected_files
+
+    def _items(self, file_name=None, decoder=None) -> Generator:
+        """:method:`FlowerpotEngine.items` with this connector's options"""
+        return self._flowerpot.items(file_name=file_name,
+                                     streaming=self.streaming,
+                                     processes=self.processes,
+                                     ordered=self.ordered,
+                                     max_in_flight=self.max_in_flight,
+                                     decoder=decoder or self.decoder,
+                                     cache=self._cache,
+                                     )
 
     @property
     def data(self) -> Generator:
         self.connect()
-        return self._flowerpot.items()
+        return self._items()
+
+    def batches(self, batch_size=10000, columns=None, batch_format='numpy') -> Generator:
+        """
+        @see :method:`foxglove.connectors.base.DataConnector.batches`
+        With 'cache_dir', batches come straight from the columnar cache and don't span files
+        within the flowerpot.
+        """
+        self.connect()
+        if self._cache is None:
+            yield from super().batches(batch_size=batch_size, columns=columns,
+                                       batch_format=batch_format)
+            return
+
+        yield from self._flowerpot.cached_batches(self._cache, batch_size=batch_size,
+                                                  columns=columns or self.decoder.columns,
+                                                  batch_format=batch_format)
+
+    def _batch_rows(self, columns=None) -> Generator[dict, None, None]:
+        decoder = self.decoder.derive(record_type=RecordType.DICT,
+                                      columns=columns or self.decoder.columns)
+        return self._items(decoder=decoder)
 
     @property
     def schema(self):
@@ -0,0 +1,169 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+from importlib import import_module
+import os
+from typing import Generator, List
+
+from foxglove.connectors.cache_utils import cache_key, evict_least_recently_used, touch
+
+
+class ColumnarCache:
+    """
+    On disk cache of files within flowerpots converted to the Arrow IPC file format.
+
+    The first read of a file within a flowerpot deserializes it as usual and saves it as an
+    Arrow table. Later reads memory map the table instead of decompressing and deserializing
+    again. Cached tables are keyed by flowerpot path, size, modification time and file name so
+    a changed flowerpot isn't served from stale tables.
+
+    Records served from the cache are the same as those deserialized from the flowerpot.
+    Fields missing from some records are remembered so they aren't given a None value. Files
+    that can't be converted without changing a value, e.g. a field that is a number in some
+    records and a string in others or an int in some and a float in others, aren't cached.
+
+    Needs the optional pyarrow package. It's imported when a cache is made, not with this
+    module, as pyarrow starts threads and flowerpots are also read with forked processes.
+    """
+    suffix = '.arrow'
+    # part of each table's key, change it when the way records are stored changes
+    version = 2
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        :param cache_dir: (str) directory for cached tables, created if needed
+        :param max_bytes: (int) optional, least recently used tables are deleted to keep the
+                total size of cached tables below this.
+        """
+        _import_pyarrow()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, flowerpot_filename, file_name) -> str:
+        stat = os.stat(flowerpot_filename)
+        key = cache_key(self.version, os.path.abspath(flowerpot_filename), stat.st_size,
+                        stat.st_mtime_ns, file_name)
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, flowerpot_filename, file_name) -> 'pyarrow.Table':
+        """
+        :returns: memory mapped :class:`pyarrow.Table` or None if the file isn't cached
+        """
+        pyarrow = _import_pyarrow()
+        path = self._path(flowerpot_filename, file_name)
+        try:
+            source = pyarrow.memory_map(path, 'r')
+        except (OSError, pyarrow.ArrowException):
+            return None
+        touch(path)
+        return pyarrow.ipc.open_file(source).read_all()
+
+    def put(self, flowerpot_filename, file_name, docs: List[dict]) -> 'pyarrow.Table':
+        """
+        Convert deserialized records and save them.
+        :returns: :class:`pyarrow.Table` or None if `docs` can't be converted, or can't be
+                  converted without changing them.
+        """
+        pyarrow = _import_pyarrow()
+        try:
+            table = _docs_to_table(docs)
+        except pyarrow.ArrowException:
+            return None
+        if not all(_identical(row, doc) for row, doc in zip(table_rows(table), docs)):
+            # e.g. ints widened to floats
+            return None
+
+        path = self._path(flowerpot_filename, file_name)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with pyarrow.OSFile(temp_path, 'wb') as sink:
+                with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            # atomic so concurrent readers never see a partial table
+            os.replace(temp_path, path)
+        except OSError:
+            # caching is an optimisation, carry on without it
+            return table
+
+        if self.max_bytes is not None:
+            evict_least_recently_used(self.cache_dir, self.max_bytes, suffix=self.suffix)
+        return table
+
+
+def _import_pyarrow():
+    try:
+        pyarrow = import_module('pyarrow')
+        import_module('pyarrow.ipc')
+    except ImportError:
+        raise ImportError("The pyarrow package is needed for a ColumnarCache")
+    return pyarrow
+
+
+# list of the fields each record doesn't have, null when it has them all
+MISSING_FIELDS_COLUMN = '__foxglove_missing_fields__'
+
+
+def _docs_to_table(docs) -> 'pyarrow.Table':
+    """
+    Column types are inferred from all values, not just those in the first record.
+    """
+    pyarrow = _import_pyarrow()
+    columns = {}
+    for doc in docs:
+        for k in doc:
+            columns.setdefault(k, None)
+    values = {k: [doc.get(k) for doc in docs] for k in columns}
+
+    missing_fields = [[k for k in columns if k not in doc] or None for doc in docs]
+    if any(missing_fields):
+        values[MISSING_FIELDS_COLUMN] = pyarrow.array(missing_fields,
+                                                      type=pyarrow.list_(pyarrow.string()))
+    return pyarrow.Table.from_pydict(values)
+
+
+def _identical(a, b) -> bool:
+    """
+    Like ==, but values must be the same type too, so 1 and 1.0 differ.
+    """
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_identical(v, b[k]) for k, v in a.items())
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_identical(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def select_columns(table, columns=None) -> 'pyarrow.Table':
+    """
+    :param columns: (list of str) optional, default is all the table's fields. Columns that
+                    aren't in the table are ignored.
+    :returns: :class:`pyarrow.Table` with just those fields' columns
+    """
+    names = [c for c in (columns or table.column_names)
+             if c in table.column_names and c != MISSING_FIELDS_COLUMN]
+    return table.select(names)
+
+
+def table_rows(table, columns=None, batch_size=65536) -> Generator[dict, None, None]:
+    """
+    Generator yielding each row of a :class:`pyarrow.Table` as a dict. Fields missing from
+    the original record aren't in the dict.
+    Args:
+        columns: (list of str) optional, only convert these columns
+    """
+    has_missing_fields = MISSING_FIELDS_COLUMN in table.column_names
+    selected = select_columns(table, columns)
+    if has_missing_fields:
+        selected = selected.append_column(MISSING_FIELDS_COLUMN,
+                                          table.column(MISSING_FIELDS_COLUMN))
+    for batch in selected.to_batches(max_chunksize=batch_size):
+        rows = batch.to_pylist()
+        if has_missing_fields:
+            for row in rows:
+                for k in row.pop(MISSING_FIELDS_COLUMN) or ():
+                    row.pop(k, None)
+        yield from rows
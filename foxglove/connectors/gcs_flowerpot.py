@@ -4,20 +4,24 @@ Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
 from tempfile import TemporaryFile
+import threading
 
 from typing import Generator, Tuple
 
 from google.auth.credentials import Credentials
 from google.cloud import storage
-from google.cloud.storage import Blob
+from google.cloud.storage import Blob, Bucket
 
 from foxglove.connectors.base import DataConnector
+from foxglove.connectors.download_cache import download_cache
 from foxglove.connectors.flowerpot import FlowerpotEngine
+from foxglove.records import RecordType
 
 
 class GcsFlowerpotConnector(DataConnector):
     engine_type = 'gs+flowerpot://'
-    optional_args = {'credentials': None}
+    optional_args = {'credentials': None, 'stream': False, 'chunk_size': None,
+                     'cache_dir': None, 'cache_max_bytes': None}
 
     def __init__(self, *args, **kwargs):
         """
@@ -26,6 +30,16 @@ class GcsFlowerpotConnector(DataConnector):
 
         additional args for GcsFlowerpotConnector
          'credentials' : (dict) for access within Google Cloud Platform
+         'stream' : (bool) read records while the flowerpot is downloading instead of
+                    downloading all of it to a temporary file first. Each read of the data
+                    downloads the flowerpot again.
+         'chunk_size' : (int) bytes requested from GCS at a time when streaming. Default is
+                    the google-cloud-storage library's default.
+         'cache_dir' : (str) keep downloaded flowerpots in this directory and read them from
+                    there until the object in GCS changes. Shared by processes on the same host.
+                    'stream' isn't used when reading from a cache.
+         'cache_max_bytes' : (int) optional, least recently used flowerpots are deleted from
+                    'cache_dir' to keep its size below this.
 
             engine_url format is gs+flowerpot://[project.]<bucket>/<path>
                     e.g. gs+flowerpot://my_project.my_bucket/some/data/file.flowerpot
@@ -35,8 +49,17 @@ class GcsFlowerpotConnector(DataConnector):
 
         self.project_name, self.bucket_name, self.flowerpot_path = \
             split_gcs_uri(kwargs['engine_url'])
-        self.bucket = get_gcs_bucket(self.bucket_name, self.project_name, self.credentials)
+        self._bucket = None # looked up on demand
         self._flowerpot = None # loaded on demand
+        self._flowerpot_lock = threading.Lock() # downloaded once if used by several threads
+        self.download_cache = download_cache(self.cache_dir, self.cache_max_bytes) \
+            if self.cache_dir else None
+
+    @property
+    def bucket(self) -> Bucket:
+        if self._bucket is None:
+            self._bucket = get_gcs_bucket(self.bucket_name, self.project_name, self.credentials)
+        return self._bucket
 
     def _get_blob(self) -> Blob:
         """Get flowerpot object from its remote path as a GCS blob"""
@@ -44,10 +67,25 @@ class GcsFlowerpotConnector(DataConnector):
 
     @property
     def flowerpot(self) -> 'LazyFlowerpotReader':
-        if self._flowerpot is None:
-            flowerpot = self._download_flowerpot()
-            self._flowerpot = FlowerpotEngine.from_file(flowerpot)
-        return self._flowerpot
+        with self._flowerpot_lock:
+            if self._flowerpot is None:
+                if self.download_cache is not None:
+                    self._flowerpot = FlowerpotEngine.from_filename(self._cached_flowerpot(),
+                                                                    codec=self.codec)
+                else:
+                    flowerpot = self._download_flowerpot()
+                    self._flowerpot = FlowerpotEngine.from_file(flowerpot, codec=self.codec)
+            return self._flowerpot
+
+    def _cached_flowerpot(self) -> str:
+        """
+        :returns: (str) path to flowerpot in :attr:`download_cache`, downloaded if needed.
+        """
+        blob = self._get_blob()
+        # generation changes whenever the object is overwritten
+        version = blob.generation or blob.md5_hash or blob.crc32c
+        key_parts = (self.bucket_name, self.flowerpot_path, version)
+        return self.download_cache.fetch(key_parts, blob.download_to_file)
 
     def _download_flowerpot(self) -> TemporaryFile:
         flowerpot_file = TemporaryFile('w+b')
@@ -55,18 +93,47 @@ class GcsFlowerpotConnector(DataConnector):
         flowerpot_file.seek(0)
         return flowerpot_file
 
+    def _streamed_items(self, decoder) -> Generator[object, None, None]:
+        """
+        Generator yielding records made by `decoder` as the flowerpot is read from GCS in
+        chunks of `chunk_size`.
+        """
+        open_args = {'chunk_size': self.chunk_size} if self.chunk_size else {}
+        with self._get_blob().open('rb', **open_args) as blob_reader:
+            flowerpot = FlowerpotEngine.from_stream(blob_reader, codec=self.codec)
+            yield from flowerpot.items(decoder=decoder)
+
+    def _items(self, decoder) -> Generator[object, None, None]:
+        if self.stream and self.download_cache is None:
+            return self._streamed_items(decoder)
+        return self.flowerpot.items(decoder=decoder)
+
     @property
     def data(self) -> Generator[object, None, None]:
-        return self.flowerpot.items()
+        return self._items(self.decoder)
+
+    def _batch_rows(self, columns=None) -> Generator[dict, None, None]:
+        decoder = self.decoder.derive(record_type=RecordType.DICT,
+                                      columns=columns or self.decoder.columns)
+        return self._items(decoder)
 
     @property
     def schema(self):
         return None
 
     def connect(self):
+        if self.stream and self.download_cache is None:
+            # downloaded when read
+            return
         # looking at this property forces lazy download
         assert self.flowerpot
 
+    def prefetch(self) -> bool:
+        if self.stream and self.download_cache is None:
+            return False
+        self.connect()
+        return True
+
     def __len__(self):
         raise NotImplementedError("TODO")
 
@@ -91,7 +158,40 @@ def split_gcs_uri(gcs_uri: str) -> Tuple[str, str]:
     return None, proj_bucket, path
 
 
+# Clients, and their HTTP connections, and buckets are shared by all connectors in the process.
+# Keys include id(credentials) as credentials aren't always hashable. The client keeps a
+# reference to its credentials so the id isn't reused while it's in the pool.
+_clients = {} # (project, id(credentials)) -> storage.Client
+_buckets = {} # (project, id(credentials), bucket_name) -> Bucket
+_pool_lock = threading.Lock()
+
+
+def get_gcs_client(project: str = None, credentials: Credentials = None) -> storage.Client:
+    """Shared GCS client for a project and credentials"""
+    key = (project, id(credentials))
+    with _pool_lock:
+        if key not in _clients:
+            _clients[key] = storage.Client(project, credentials)
+        return _clients[key]
+
+
 def get_gcs_bucket(bucket_name: str, project: str = None, credentials: Credentials = None):
-    """Convenience method for getting a GCS Bucket() object from a bucket name"""
-    storage_client = storage.Client(project, credentials)
-    return storage_client.get_bucket(bucket_name)
+    """
+    Convenience method for getting a GCS Bucket() object from a bucket name. Buckets are
+    looked up once per process.
+    """
+    key = (project, id(credentials), bucket_name)
+    with _pool_lock:
+        bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = get_gcs_client(project, credentials).get_bucket(bucket_name)
+        with _pool_lock:
+            bucket = _buckets.setdefault(key, bucket)
+    return bucket
+
+
+def clear_gcs_pool():
+    """Forget shared clients and buckets, e.g. after credentials have been revoked or in tests"""
+    with _pool_lock:
+        _clients.clear()
+        _buckets.clear()
@@ -8,18 +8,45 @@ Created on 16 May 2019
 
 @author: parkes25
 '''
+from collections import deque, namedtuple
 from datetime import datetime
+import heapq
+import threading
+import time
 from typing import Generator
 
 from kafka import KafkaConsumer, TopicPartition
-from kafka.structs import OffsetAndTimestamp
 
 from foxglove.connectors.base import DataConnector
-from foxglove.pinnate import Pinnate
+from foxglove.connectors.checkpoints import SqliteCheckpointStore
+from foxglove.deserializers import DESERIALIZERS, get_deserializer
+from foxglove.records import RecordType
+
+# record for a message when 'with_metadata' is used. value is made into the 'record_type'.
+KafkaRecord = namedtuple('KafkaRecord', 'topic partition offset timestamp key value')
+
+# (bootstrap server, topic) -> partition ids. Shared by connectors in this process.
+_topic_partitions = {}
+_metadata_lock = threading.Lock()
+
+
+def clear_metadata_cache():
+    """Forget cached topic metadata, e.g. after partitions have been added or in tests"""
+    with _metadata_lock:
+        _topic_partitions.clear()
 
 
 class KafkaConnector(DataConnector):
     engine_type = 'kafka://'
+    # passed to :class:`KafkaConsumer` when given, see its docs for what they do
+    consumer_args = ('fetch_min_bytes', 'fetch_max_wait_ms', 'fetch_max_bytes',
+                     'max_partition_fetch_bytes', 'max_poll_records', 'receive_buffer_bytes')
+    optional_args = {'concurrent_partitions': False, 'ordering': 'timestamp',
+                     'checkpoint_file': None, 'checkpoint_name': None, 'unbounded': False,
+                     'deserializer': 'json', 'avro_schema': None, 'with_metadata': False,
+                     **{arg: None for arg in consumer_args}}
+    orderings = ('timestamp', 'unordered')
+    poll_timeout_ms = 1000
 
     def __init__(self, *args, **kwargs):
         """
@@ -27,70 +54,167 @@ class KafkaConnector(DataConnector):
         Args: @see :class:`connectors.base.DataConnector`
 
         additional args for KafkaConnector
-         None
+         'concurrent_partitions' : (bool) fetch from all partitions at once instead of reading
+                    each partition in turn.
+         'ordering' : (str) only used with 'concurrent_partitions'. 'timestamp' to merge
+                    messages from all partitions in timestamp order, 'unordered' to yield them
+                    as they arrive, which needs less buffering.
+         'fetch_min_bytes', 'fetch_max_wait_ms', 'fetch_max_bytes', 'max_partition_fetch_bytes',
+         'max_poll_records', 'receive_buffer_bytes' : (int) tune fetching. Passed to
+                    :class:`kafka.KafkaConsumer`, its defaults are used for those not given.
+                    e.g. bigger fetches and polls for fewer round trips when reading a lot.
+         'checkpoint_file' : (str) SQLite file recording the offset reached in each partition,
+                    @see :class:`foxglove.connectors.checkpoints.SqliteCheckpointStore`. Reads
+                    start from the checkpoint, instead of the start param, for partitions it
+                    has. The checkpoint is saved when a read finishes or is stopped. A message
+                    counts as read once the next one has been asked for.
+         'checkpoint_name' : (str) identifies the checkpoint within the file. Default is the
+                    bootstrap server.
+         'unbounded' : (bool) keep reading new messages as they arrive, forever. The end param
+                    isn't used. See :method:`micro_batches`.
+         'deserializer' : (str) how message values are encoded. 'json', 'msgpack', 'avro' or
+                    'raw' to yield values as bytes. @see :mod:`foxglove.deserializers`
+         'avro_schema' : (str) path to Avro schema file for the 'avro' deserializer
+         'with_metadata' : (bool) yield :class:`KafkaRecord` tuples of the message's topic,
+                    partition, offset, timestamp, key and value, made into 'record_type'.
 
         Connection information-
             engine_url format is kafka://bootstrap_server/topic=<topic>;[start params;][end params;]
         start and end params can be partitions with offsets or '@' notation to use dates.
         e.g. kafka://bionic/topic=foobar;start=@(2019-05-15 08:00:00);end=@(2019-05-15 18:00:00);
+             kafka://bionic/topic=foobar;start=0:1500,1:1200;end=0:2000,1:1800;
+        Partition offsets list the partitions to read; an offset is of the first message to
+        read for start and the first message not to read for end. Without a start, partitions
+        are read from the earliest message. Without an end, or for a partition not listed in
+        the end param, up to the latest message.
         """
         super().__init__(*args, **kwargs)
+        if self.ordering not in self.orderings:
+            raise ValueError(f"Unknown ordering: {self.ordering}")
+        if self.deserializer not in DESERIALIZERS:
+            raise ValueError(f"Unknown deserializer: {self.deserializer}")
+        if self.deserializer == 'raw':
+            self.decoder = self.decoder.derive(record_type=RecordType.RAW)
+        elif self.deserializer != 'json':
+            # 'json' uses the connector's codec, see 'json_backend'
+            self.decoder = self.decoder.derive(
+                codec=get_deserializer(self.deserializer, avro_schema=self.avro_schema))
+
+        self.checkpoint_store = SqliteCheckpointStore(self.checkpoint_file) \
+            if self.checkpoint_file else None
+        self.consumed_offsets = {} # partition -> offset of next message, see 'checkpoint_file'
+        self._uncommitted = [] # messages in batch from :method:`micro_batches`
 
         # set by :method:`connect`
         self.bootstrap_server = self.topic = self.start_params = self.end_params = None
-        self.start_p_offsets = self.end_p_offsets = None
-        self.available_topics = None
+        self.start_p_offsets = self.end_p_offsets = None # TopicPartition -> (int) offset
         self.client = None
 
     def connect(self):
         if self.client is None:
             self.bootstrap_server, self.topic, self.start_params, self.end_params = \
                 self._decode_engine_url()
-            self.client = KafkaConsumer(bootstrap_servers=self.bootstrap_server)
-
-            # <WTF> https://github.com/dpkp/kafka-python/issues/601
-            self.available_topics = self.client.topics()
-            # </WTF>
-            
-            # might as well use it
-            assert self.topic in self.available_topics
-
-            # setup start and end partitions and offsets
-#             self.client.seek_to_beginning()
-            # datetime is only start/end implemented
-            assert isinstance(self.start_params, datetime) and isinstance(self.end_params, datetime)
-            start = int(self.start_params.timestamp() * 1000)
-            end = int(self.end_params.timestamp() * 1000)
+            self.client = KafkaConsumer(bootstrap_servers=self.bootstrap_server,
+                                        **self.consumer_config)
+
+            if isinstance(self.start_params, dict):
+                partitions = sorted(self.start_params)
+            else:
+                partitions = self._partitions()
+            tps = [TopicPartition(topic=self.topic, partition=p) for p in partitions]
+
+            checkpoint = {}
+            if self.checkpoint_store is not None:
+                checkpoint = self.checkpoint_store.load(self.checkpoint_id, self.topic)
+            start_offsets = self._resolve_offsets(self.start_params,
+                                                  [tp for tp in tps
+                                                   if tp.partition not in checkpoint])
+            end_offsets = self._resolve_offsets(self.end_params, tps)
+
+            # A start or end time after the last message, or no end, is the offset the next
+            # message will have. No start is the earliest message. An end offset given in
+            # engine_url can't be after the next message's offset, it would never be reached.
+            from_log_end = [tp for tp in tps if end_offsets[tp] is None
+                            or isinstance(self.end_params, dict)
+                            or start_offsets.get(tp, 0) is None and self.start_params is not None]
+            from_beginning = [tp for tp in tps if tp in start_offsets
+                              and start_offsets[tp] is None and self.start_params is None]
+            log_end_offsets = self.client.end_offsets(from_log_end) if from_log_end else {}
+            beginning_offsets = self.client.beginning_offsets(from_beginning) \
+                if from_beginning else {}
+
+            # ranges are start offset, inclusive, to end offset, exclusive
+            self.start_p_offsets = {}
+            self.end_p_offsets = {}
+            for tp in tps:
+                end_offset = end_offsets[tp] if end_offsets[tp] is not None \
+                    else log_end_offsets[tp]
+                if tp in log_end_offsets:
+                    end_offset = min(end_offset, log_end_offsets[tp])
+                if tp.partition in checkpoint:
+                    start_offset = checkpoint[tp.partition]
+                elif start_offsets[tp] is not None:
+                    start_offset = start_offsets[tp]
+                else:
+                    start_offset = beginning_offsets.get(tp, end_offset)
+                self.start_p_offsets[tp] = start_offset
+                self.end_p_offsets[tp] = end_offset
+
+    @property
+    def checkpoint_id(self):
+        return self.checkpoint_name or self.bootstrap_server
+
+    def _resolve_offsets(self, params, tps) -> dict:
+        """
+        :param params: (None, datetime or dict) start or end param from engine_url
+        :returns: (dict) :class:`TopicPartition` -> (int) offset or None when `params` doesn't
+                  give one, including for a time after the last message.
+        """
+        if isinstance(params, datetime):
+            if not tps:
+                return {}
+            timestamp = int(params.timestamp() * 1000)
+            found = self.client.offsets_for_times({tp: timestamp for tp in tps})
+            return {tp: found[tp].offset if found[tp] is not None else None for tp in tps}
+        if isinstance(params, dict):
+            return {tp: params.get(tp.partition) for tp in tps}
+        return {tp: None for tp in tps}
+
+    def save_checkpoint(self):
+        """
+        Record the offsets of messages read so far in the checkpoint file.
+        """
+        if self.checkpoint_store is not None and self.consumed_offsets:
+            self.checkpoint_store.save(self.checkpoint_id, self.topic, self.consumed_offsets)
 
+    def _partitions(self):
+        """
+        Partition ids of the topic. Topic metadata is fetched once per process for each
+        bootstrap server and topic.
+        """
+        key = (self.bootstrap_server, self.topic)
+        with _metadata_lock:
+            partitions = _topic_partitions.get(key)
+        if partitions is None:
             partitions = self.client.partitions_for_topic(self.topic)
-            tx = {TopicPartition(topic=self.topic, partition=p):start
-                  for p in list(partitions)}
-            self.start_p_offsets = self.client.offsets_for_times(tx)
-
-            # if you give a timestamp after the last record it returns None
-            for tp, offset_details in self.start_p_offsets.items():
-                if offset_details is None:
-                    raise ValueError("Start date outside of available messages")
-
-            tx = {TopicPartition(topic=self.topic, partition=p):end
-                  for p in list(partitions)}
-            self.end_p_offsets = self.client.offsets_for_times(tx)
-            
-            # as above - out of range, for end offset give something useful
-            for tp, offset_details in self.end_p_offsets.items():
-                if offset_details is None:
-                    # go to last message. I'm not 100% sure this is correct
-                    end_offsets = self.client.end_offsets([tp])
-                    offset = end_offsets[tp]-1
-                    self.end_p_offsets[tp] = OffsetAndTimestamp(offset=offset, timestamp=None)
+            if not partitions:
+                raise ValueError(f"Unknown topic: {self.topic}")
+            with _metadata_lock:
+                _topic_partitions[key] = partitions
+        return sorted(partitions)
+
+    @property
+    def consumer_config(self) -> dict:
+        """Tuning args given to this connector that are passed to :class:`KafkaConsumer`"""
+        return {arg: getattr(self, arg) for arg in self.consumer_args
+                if getattr(self, arg) is not None}
 
     def _decode_engine_url(self):
         """
         Returns:
             bootstrap_server, topic, start_params, end_params
             bootstrap_server and topic are (str)
-            start_params, end_params are (None), (datetime) or (mixed) - not implemented
-                                but will be partition+offsets pairs
+            start_params, end_params are (None), (datetime) or (dict) partition -> offset
         """
         date_format = "%Y-%m-%d %H:%M:%S"
         r = dict(topic=None, start=None, end=None)
@@ -102,15 +226,20 @@ class KafkaConnector(DataConnector):
             k,v = param_section.split('=', 1)
             if k in r:
                 r[k] = v
-        # resolve to dates if needed
-        # partition+offset not implemented so start and end must be None or start with @
-        # to resolve to a datetime.
+        # resolve to dates or partition offsets
         for position in ('start', 'end'):
             p_marker = r[position]
-            if p_marker is not None:
-                assert p_marker.startswith('@(') and p_marker.endswith(')')
+            if p_marker is None:
+                continue
+            if p_marker.startswith('@(') and p_marker.endswith(')'):
                 date_str = p_marker[2:-1]
                 r[position] = datetime.strptime(date_str, date_format)
+                continue
+            try:
+                r[position] = {int(partition): int(offset) for partition, offset
+                               in (pair.split(':') for pair in p_marker.split(','))}
+            except ValueError:
+                raise ValueError(f"Expected @(date) or partition:offset list: {p_marker}")
 
         return bootstrap_server, r['topic'], r['start'], r['end']
 
@@ -129,41 +258,239 @@ class KafkaConnector(DataConnector):
         for range given in self.engine_url
         """
         self.connect()
-        for topic_partition, start_offset_time in self.start_p_offsets.items():
-            end_offset_time = self.end_p_offsets[topic_partition]
-            yield topic_partition.partition, start_offset_time.offset, end_offset_time.offset
+        for topic_partition, start_offset in self.start_p_offsets.items():
+            yield topic_partition.partition, start_offset, self.end_p_offsets[topic_partition]
 
     @property
     def data(self) -> Generator:
         """
         Generator yielding just the value of the record from Kafka.
-        Value is made into Pinnate object.
+        Value is made into the connector's 'record_type', default is a Pinnate object.
+        """
+        return self._records(self._messages())
+
+    def _records(self, messages) -> Generator:
+        """
+        Generator yielding records made from `messages`, @see 'with_metadata'
+        """
+        if not self.with_metadata:
+            yield from self.decoder.decode_all(m.value for m in messages)
+            return
+
+        decode_all = self.decoder.decode_all
+        for m in messages:
+            # 'where' can drop the value
+            for value in decode_all((m.value,)):
+                yield KafkaRecord(m.topic, m.partition, m.offset, m.timestamp, m.key, value)
+
+    def _batch_rows(self, columns=None) -> Generator[dict, None, None]:
+        decoder = self.decoder.derive(record_type=RecordType.DICT,
+                                      columns=columns or self.decoder.columns)
+        return decoder.decode_all(m.value for m in self._messages())
+
+    def _messages(self) -> Generator:
+        """
+        Generator yielding each message in the range given in self.engine_url.
 
         See https://kafka-python.readthedocs.io/en/master/apidoc/KafkaConsumer.html
         useful attribs include
         m.offset, m.partition, m.timestamp, m.key, m.value
         """
+        try:
+            for m in self._message_source():
+                if m is None:
+                    continue
+                yield m
+                # reached when the next message is asked for so `m` has been dealt with
+                self.consumed_offsets[m.partition] = m.offset + 1
+        finally:
+            self.save_checkpoint()
+
+    def _message_source(self) -> Generator:
+        """
+        Generator yielding messages, and None after a poll that found nothing when
+        'unbounded'.
+        """
         self.connect()
+        if self.unbounded:
+            return self._tail_messages()
+        if self.concurrent_partitions:
+            return self._concurrent_messages(self.ordering == 'timestamp')
+        return self._sequential_messages()
 
+    def micro_batches(self, max_records=1000, max_wait_s=5.0, until=None) -> Generator:
+        """
+        Generator yielding lists of records, in the connector's 'record_type', for processing
+        a batch at a time. Mostly for 'unbounded' connectors, e.g.
+        ...
+        for batch in self.my_topic.micro_batches(max_records=500, max_wait_s=10):
+            process(batch)
+
+        Messages are only fetched when the next batch is asked for so a slow consumer slows
+        fetching rather than filling memory. A batch is committed when the next batch is asked
+        for or :method:`commit` is called, i.e. after it has been processed. With
+        'checkpoint_file' committing saves the checkpoint so a restart carries on from the
+        first batch that wasn't processed.
+
+        Args:
+            max_records: (int) yield a batch when it has this many messages
+            max_wait_s: (float) or when this many seconds have passed since its first message
+            until: (callable) optional, checked after each poll, stop when it returns True
+        """
+        batch = []
+        batch_started = None
+        try:
+            for m in self._message_source():
+                if m is not None:
+                    batch.append(m)
+                    batch_started = batch_started or time.monotonic()
+                if batch and (len(batch) >= max_records
+                              or time.monotonic() - batch_started >= max_wait_s):
+                    yield self._prepare_batch(batch)
+                    self.commit()
+                    batch = []
+                    batch_started = None
+                if until is not None and until():
+                    break
+
+            if batch:
+                yield self._prepare_batch(batch)
+                self.commit()
+        finally:
+            # :method:`commit` is called by anything that processed the last batch
+            self._uncommitted = []
+
+    def _prepare_batch(self, batch) -> list:
+        self._uncommitted = batch
+        return list(self._records(batch))
+
+    def commit(self):
+        """
+        Mark the batch most recently yielded by :method:`micro_batches` as processed and save
+        the checkpoint, if there is one.
+        """
+        for m in self._uncommitted:
+            self.consumed_offsets[m.partition] = m.offset + 1
+        self._uncommitted = []
+        self.save_checkpoint()
+
+    def _tail_messages(self) -> Generator:
+        """
+        Generator yielding messages from all partitions, from the start offsets, forever.
+        Yields None when a poll finds nothing new.
+        """
+        self.client.assign(list(self.start_p_offsets))
+        for tp, start_offset in self.start_p_offsets.items():
+            self.client.seek(tp, start_offset)
+        while True:
+            batches = self.client.poll(timeout_ms=self.poll_timeout_ms)
+            if not batches:
+                yield None
+                continue
+            for messages in batches.values():
+                yield from messages
+
+    def _sequential_messages(self) -> Generator:
+        """
+        Generator like :method:`_messages` reading one partition after another.
+        """
         for partition_id, start_offset, end_offset in self._partition_ranges():
+            if end_offset <= start_offset:
+                # no messages in range
+                continue
             # TODO - confirm this can never jump to another partition
             tp = TopicPartition(topic=self.topic, partition=partition_id)
-            items_to_fetch = end_offset-start_offset
             self.client.assign([tp])
             self.client.seek(tp, start_offset)
+            yield from self._poll_partition(tp, end_offset)
+
+    def _poll_partition(self, tp, end_offset) -> Generator:
+        """
+        Generator yielding messages from the assigned partition `tp` up to, but not including,
+        `end_offset`. Messages are fetched a batch at a time, see 'max_poll_records', which
+        is much quicker than iterating the consumer.
+
+        Fetching stops as soon as the message before `end_offset` has been seen so a range
+        ending at the last message in the partition doesn't wait for another to arrive. That
+        message might never arrive, e.g. it's a transaction marker or has been compacted, so
+        fetching also stops once the consumer's position has reached `end_offset`.
+        """
+        while True:
+            batches = self.client.poll(timeout_ms=self.poll_timeout_ms)
+            for m in batches.get(tp, ()):
+                if m.offset < end_offset:
+                    yield m
+                if m.offset >= end_offset - 1:
+                    return
+            if self.client.position(tp) >= end_offset:
+                return
+
+    def _concurrent_messages(self, timestamp_order) -> Generator:
+        """
+        Generator like :method:`_messages` that fetches from every partition at once, with
+        one consumer assigned all partitions.
 
-            if items_to_fetch <= 0:
-                msg = f"Invalid offsets {start_offset}:{end_offset} for partition {partition_id}"
-                raise ValueError(msg)
+        Each partition is paused when the message before its end offset has been seen, see
+        :method:`_poll_partition`. With `timestamp_order`,
+        a message is only yielded when every partition still being read has a message
+        buffered, so the earliest can be chosen.
+        """
+        end_offsets = {}
+        start_offsets = {}
+        for partition_id, start_offset, end_offset in self._partition_ranges():
+            if end_offset <= start_offset:
+                # no messages in range
+                continue
+            tp = TopicPartition(topic=self.topic, partition=partition_id)
+            start_offsets[tp] = start_offset
+            end_offsets[tp] = end_offset
 
-            for m in self.client:
+        self.client.assign(list(end_offsets))
+        for tp, start_offset in start_offsets.items():
+            self.client.seek(tp, start_offset)
+
+        buffers = {tp: deque() for tp in end_offsets}
+        heads = [] # heap of (timestamp, partition) of first message in each non-empty buffer
+        fetching = set(end_offsets) # partitions that haven't reached their end offset
+        while fetching or heads:
+            if fetching and not (timestamp_order and all(buffers[tp] for tp in fetching)):
+                batches = self.client.poll(timeout_ms=self.poll_timeout_ms)
+                for tp, messages in batches.items():
+                    if tp not in fetching:
+                        continue
+                    buffer = buffers[tp]
+                    was_empty = not buffer
+                    end_offset = end_offsets[tp]
+                    for m in messages:
+                        if m.offset < end_offset:
+                            buffer.append(m)
+                        if m.offset >= end_offset - 1:
+                            fetching.discard(tp)
+                            self.client.pause(tp)
+                            break
+                    if was_empty and buffer:
+                        heapq.heappush(heads, (buffer[0].timestamp, tp.partition, tp))
+                # the message before the end offset might not exist, see _poll_partition
+                for tp in [tp for tp in fetching
+                           if self.client.position(tp) >= end_offsets[tp]]:
+                    fetching.discard(tp)
+                    self.client.pause(tp)
 
-                #dt = datetime.utcfromtimestamp(m.timestamp/1000).strftime('%Y-%m-%d %H:%M:%S')
-                #msg = "{}-{} {} key:{} value:{}".format(m.offset, m.partition, dt, m.key, m.value)
-                #if m.offset == 100000:
-                #    print("now")
-                #print(msg)
-                yield Pinnate(data=m.value)
+            if not timestamp_order:
+                heads.clear()
+                for buffer in buffers.values():
+                    yield from buffer
+                    buffer.clear()
+                continue
 
-                if m.offset >= end_offset:
+            if not all(buffers[tp] for tp in fetching):
+                continue
+            while heads:
+                _, _, tp = heapq.heappop(heads)
+                buffer = buffers[tp]
+                yield buffer.popleft()
+                if buffer:
+                    heapq.heappush(heads, (buffer[0].timestamp, tp.partition, tp))
+                elif tp in fetching:
+                    # can't know what's next until this partition has more messages
                     break
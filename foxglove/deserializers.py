@@ -0,0 +1,86 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+Deserializers for binary encoded records, e.g. Kafka message values. They can be used in place
+of a :class:`foxglove.json_codec.JsonCodec` by :class:`foxglove.records.RecordDecoder`.
+
+The libraries they need are optional and imported when a deserializer is made-
+    msgpack : msgpack
+    avro : fastavro
+"""
+from functools import partial
+from importlib import import_module
+import io
+import json
+
+from foxglove.json_codec import get_codec
+
+DESERIALIZERS = ('json', 'msgpack', 'avro', 'raw')
+
+
+class Deserializer:
+    """
+    Deserialize bytes to python objects. Like :class:`foxglove.json_codec.JsonCodec` but
+    can't serialize.
+    """
+    # serialized records aren't JSON text so :class:`foxglove.records.RecordFilter` can't
+    # search them before deserializing
+    is_json = False
+
+    def __init__(self, name, loads):
+        """
+        :param name: (str) one of :data:`DESERIALIZERS`
+        :param loads: (callable) bytes -> python object
+        """
+        self.name = name
+        self.loads = loads
+
+    def __repr__(self):
+        return f"<Deserializer {self.name}>"
+
+
+def _import(package, deserializer):
+    try:
+        return import_module(package)
+    except ImportError:
+        raise ImportError(f"The {package} package is needed for the {deserializer} deserializer")
+
+
+def _msgpack_deserializer():
+    msgpack = _import('msgpack', 'msgpack')
+    return Deserializer('msgpack', partial(msgpack.unpackb, raw=False))
+
+
+def _avro_deserializer(schema_file):
+    if schema_file is None:
+        raise ValueError("The avro deserializer needs a schema file")
+    fastavro = _import('fastavro', 'avro')
+    with open(schema_file) as f:
+        schema = fastavro.parse_schema(json.load(f))
+    schemaless_reader = fastavro.schemaless_reader
+
+    def loads(raw):
+        return schemaless_reader(io.BytesIO(raw), schema)
+
+    return Deserializer('avro', loads)
+
+
+def get_deserializer(name='json', json_backend=None, avro_schema=None):
+    """
+    :param name: (str) one of :data:`DESERIALIZERS`. 'raw' records aren't deserialized, use
+            :attr:`foxglove.records.RecordType.RAW`, so this gives None.
+    :param json_backend: (str) for 'json', @see :func:`foxglove.json_codec.get_codec`
+    :param avro_schema: (str) for 'avro', path to a schema (.avsc) file. Records are Avro
+            binary encoded without a header, i.e. as written by a schemaless writer.
+    :returns: :class:`Deserializer` or :class:`foxglove.json_codec.JsonCodec`
+    """
+    if name not in DESERIALIZERS:
+        raise ValueError(f"Unknown deserializer: {name}")
+    if name == 'json':
+        return get_codec(json_backend)
+    if name == 'msgpack':
+        return _msgpack_deserializer()
+    if name == 'avro':
+        return _avro_deserializer(avro_schema)
+    return None
@@ -0,0 +1,114 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+from importlib import import_module
+import json
+
+
+class JsonCodec:
+    """
+    Serialize and deserialize JSON with one of several interchangeable libraries.
+
+    >>> codec = get_codec('json')
+    >>> codec.loads(b'{"my_string": "abcdef"}')
+    {'my_string': 'abcdef'}
+    >>> codec.dumps({'my_string': 'abcdef'})
+    '{"my_string": "abcdef"}'
+
+    Use :func:`get_codec` to make instances.
+    """
+    is_json = True # @see :class:`foxglove.deserializers.Deserializer`
+
+    def __init__(self, name, loads, dumps):
+        """
+        :param name: (str) name of backend, one of :data:`BACKENDS`
+        :param loads: (callable) str or bytes -> python object
+        :param dumps: (callable) python object -> str
+        """
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return f"<JsonCodec {self.name}>"
+
+    def __reduce__(self):
+        # functions from C extensions can't always be pickled; rebuild by name instead. This
+        # allows codecs to be sent to worker processes.
+        return get_codec, (self.name,)
+
+
+def _orjson_codec():
+    orjson = import_module('orjson')
+    return JsonCodec('orjson', orjson.loads, lambda obj: orjson.dumps(obj).decode('utf-8'))
+
+
+def _simdjson_codec():
+    simdjson = import_module('simdjson')
+    return JsonCodec('simdjson', simdjson.loads, json.dumps)
+
+
+def _ujson_codec():
+    ujson = import_module('ujson')
+    return JsonCodec('ujson', ujson.loads, ujson.dumps)
+
+
+def _stdlib_codec():
+    return JsonCodec('json', json.loads, json.dumps)
+
+
+# In order of preference when automatically choosing.
+BACKENDS = {'orjson': _orjson_codec,
+            'simdjson': _simdjson_codec,
+            'ujson': _ujson_codec,
+            'json': _stdlib_codec,
+            }
+
+_codecs = {} # cache of instantiated codecs, key is backend name
+
+
+def get_codec(name=None) -> JsonCodec:
+    """
+    :param name: (str) one of :data:`BACKENDS` or 'auto' to use the fastest installed. Default,
+            None, is 'json', the standard library.
+    :returns: :class:`JsonCodec`
+
+    The faster backends don't read everything the standard library writes. orjson and
+    simdjson reject NaN and Infinity, which `json.dumps` writes by default. orjson reads
+    integers bigger than 64 bits as floats, losing precision, and simdjson rejects them. So
+    they are only used when asked for.
+    """
+    if name is None:
+        name = 'json'
+    if name == 'auto':
+        for backend_name in BACKENDS:
+            try:
+                return get_codec(backend_name)
+            except ValueError:
+                continue
+
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend: {name}")
+
+    if name not in _codecs:
+        try:
+            _codecs[name] = BACKENDS[name]()
+        except ImportError:
+            raise ValueError(f"JSON backend {name} isn't installed")
+    return _codecs[name]
+
+
+def available_backends():
+    """
+    :returns: (list of str) names of backends that are installed, in order of preference.
+    """
+    available = []
+    for backend_name in BACKENDS:
+        try:
+            get_codec(backend_name)
+        except ValueError:
+            continue
+        available.append(backend_name)
+    return available
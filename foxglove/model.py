@@ -3,9 +3,11 @@
 Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import time
 
-from foxglove.connectors.fake import FakeDataConnector
+from foxglove.connectors.base import AccessMode, DataConnector
 
 class Model:
     """
@@ -24,26 +26,96 @@ class Model:
         self.log_to_stdout = True
         self.external_logger = None
 
+        # fetch remote datasets that are read, e.g. from cloud storage, concurrently before
+        # :method:`build`. Otherwise each is fetched when :method:`build` first uses it.
+        self.prefetch = False
+        self.prefetch_concurrency = 4
+
+        self._stopping = False # see :method:`stop`
+
     def go(self):
         """
         Run the model.
         """
+        if self.prefetch:
+            self.prefetch_datasets()
         self.build()
 
+    def prefetch_datasets(self):
+        """
+        Call :method:`DataConnector.prefetch` for every dataset that is read, at most
+        `prefetch_concurrency` at a time, and log how long each took.
+        """
+        to_fetch = {name: connector for name, connector in self.datasets().items()
+                    if connector.access == AccessMode.READ}
+        if not to_fetch:
+            return
+
+        def timed_prefetch(connector):
+            start = time.perf_counter()
+            fetched = connector.prefetch()
+            return fetched, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.prefetch_concurrency) as executor:
+            futures = {executor.submit(timed_prefetch, connector): name
+                       for name, connector in to_fetch.items()}
+            for future in as_completed(futures):
+                fetched, seconds = future.result()
+                if fetched:
+                    self.log(f"Prefetched {futures[future]} in {seconds:.2f}s")
+        self.log(f"Prefetching datasets took {time.perf_counter() - start:.2f}s")
+
     def build(self):
         raise NotImplementedError()
 
+    def go_streaming(self, dataset, max_records=1000, max_wait_s=5.0):
+        """
+        Run the model continuously. :method:`build_batch` is called with each micro batch of
+        records from `dataset` and the batch is committed when it returns, so a model that is
+        restarted carries on from the first batch it hadn't finished.
+        Args:
+            dataset: a connector with :method:`micro_batches`, e.g. an 'unbounded'
+                    :class:`foxglove.connectors.kafka_connector.KafkaConnector`
+            max_records, max_wait_s: @see :method:`KafkaConnector.micro_batches`
+        Runs until :method:`stop` is called or `dataset` has no more data.
+        """
+        self._stopping = False
+        batches = dataset.micro_batches(max_records=max_records, max_wait_s=max_wait_s,
+                                        until=lambda: self._stopping)
+        for batch in batches:
+            start = time.perf_counter()
+            self.build_batch(batch)
+            dataset.commit()
+            self.log(f"Built batch of {len(batch)} records in {time.perf_counter() - start:.2f}s")
+            if self._stopping:
+                break
+        batches.close()
+
+    def build_batch(self, batch):
+        """
+        Process one micro batch of records. @see :method:`go_streaming`
+        """
+        raise NotImplementedError()
+
+    def stop(self):
+        """
+        Finish :method:`go_streaming` after the batch being built, or the next poll if waiting
+        for data. Can be called from :method:`build_batch` or another thread.
+        """
+        self._stopping = True
+
     def datasets(self):
         """
         :returns (dict) of dataset connections for this model.
                 key is class variable name
-                value is :class:`foxglove.Connect`
+                value is :class:`foxglove.connectors.base.DataConnector`
         """
         # find :class:`foxglove.Connect` connections to datasets
         connections = {}
         for obj_name in dir(self):
             obj = getattr(self, obj_name)
-            if isinstance(obj, FakeDataConnector):
+            if isinstance(obj, DataConnector):
                 connections[obj_name] = obj
 
         return connections
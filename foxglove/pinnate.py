@@ -3,7 +3,7 @@
 Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
-import json
+from foxglove.json_codec import get_codec
 
 class Pinnate:
     """
@@ -27,16 +27,28 @@ class Pinnate:
     [1, 2, <foxglove.pinnate.Pinnate object at 0x108526e10>]
     >>> a.my_things[2].three
     3
+
+    A supplied dictionary isn't copied, it's used by the Pinnate so changes made through
+    either are seen by both. Nested dictionaries are wrapped in a Pinnate the first time they
+    are accessed and the wrapper is re-used while the value is the same dictionary. Lists
+    are copied, with dictionaries wrapped, each time they are accessed.
     """
+    __slots__ = ('_attr', '_wrapped')
+
     def __init__(self, data=None):
         """
         :param data: dictionary or dictionary encoded in json or instance of Pinnate
         """
-        self._attr = {}
-        if isinstance(data, self.__class__):
-            self._attr = data._attr
-        elif data:
-            self.load(data, merge=False)
+        # key -> Pinnate or list of wrapped children for values in _attr. Created on demand.
+        _set_slot(self, '_wrapped', None)
+        if isinstance(data, dict):
+            _set_slot(self, '_attr', data)
+        elif isinstance(data, Pinnate):
+            _set_slot(self, '_attr', data._attr)
+        else:
+            _set_slot(self, '_attr', {})
+            if data:
+                self.load(data, merge=False)
 
     def __unicode__(self):
         d = u', '.join([u"{}:{}".format(k, v) for k, v in self._attr.items()])
@@ -49,40 +61,80 @@ class Pinnate:
         return self._attr.keys()
 
     def values(self):
-        return self._attr.values()
+        return [self._wrap(k) for k in self._attr]
 
     def items(self):
-        return self._attr.items()
+        return [(k, self._wrap(k)) for k in self._attr]
 
     def __contains__(self, key):
         return key in self._attr
 
     def as_dict(self):
-        return {k: v.as_dict() if isinstance(v, self.__class__) else v for k, v in self._attr.items()}
+        return {k: _as_plain(v) for k, v in self._attr.items()}
 
-    def __getattr__(self, attr):
-        if attr not in self._attr:
-            raise AttributeError("{} instance has no attribute '{}'".format(self.__class__.__name__, attr))
-        if isinstance(self._attr[attr], list):
-            return [self.__class__(s) if isinstance(s, (list, dict)) else s for s in self._attr[attr]]
-        elif isinstance(self._attr[attr], dict):
-            return self.__class__(self._attr[attr])
+    def _wrap(self, key, wrap_lists=False):
+        """
+        Value for `key` with a dict value wrapped in a :class:`Pinnate`. Optionally a list
+        value is copied with any dict items wrapped.
+        """
+        value = self._attr[key]
+        if isinstance(value, dict) or (wrap_lists and isinstance(value, list)):
+            return self._cached_wrapper(key, value)
+        return value
+
+    def _cached_wrapper(self, key, value):
+        if isinstance(value, list):
+            # a cached copy would go stale, or be changed instead of the record
+            return _wrap_list(value)
+        wrapped = self._wrapped
+        if wrapped is None:
+            wrapped = {}
+            _set_slot(self, '_wrapped', wrapped)
         else:
-            return self._attr[attr]
+            wrapper = wrapped.get(key)
+            # value may have been replaced without this Pinnate knowing, e.g. in the dict it
+            # was made from
+            if wrapper is not None and wrapper._attr is value:
+                return wrapper
+        wrapper = wrapped[key] = Pinnate(value)
+        return wrapper
+
+    def _forget(self, key):
+        """Drop cached wrapper after the value for `key` has been replaced."""
+        if self._wrapped is not None:
+            self._wrapped.pop(key, None)
+
+    def __getattr__(self, attr):
+        # only called when normal lookup fails, which includes unset slots, e.g. while being
+        # unpickled.
+        if attr in _SLOTS:
+            raise AttributeError(attr)
+        try:
+            value = self._attr[attr]
+        except KeyError:
+            msg = "{} instance has no attribute '{}'".format(self.__class__.__name__, attr)
+            raise AttributeError(msg) from None
+        if isinstance(value, (dict, list)):
+            return self._cached_wrapper(attr, value)
+        return value
 
     def __setattr__(self, attr, val):
-        super(Pinnate, self).__setattr__(attr, val)
-        if attr != '_attr':
-            self._attr[attr] = val
+        if attr in _SLOTS:
+            _set_slot(self, attr, val)
+        else:
+            self[attr] = val
 
     def __getitem__(self, key):
-        return self._attr[key]
+        return self._wrap(key)
 
     def __setitem__(self, key, value):
         self._attr[key] = value
+        self._forget(key)
 
     def get(self, key, default=None):
-        return self._attr.get(key, default)
+        if key not in self._attr:
+            return default
+        return self._wrap(key)
 
     def load(self, data, merge=False):
         """
@@ -91,7 +143,7 @@ class Pinnate:
         """
 
         if not isinstance(data, dict):
-            data = json.loads(data)
+            data = get_codec().loads(data)
 
         if merge:
             self.merge(data)
@@ -106,10 +158,8 @@ class Pinnate:
         :param data: dictionary or dictionary encoded in json
         """
         for k, v in data.items():
-            if isinstance(v, dict):
-                self._attr[k] = Pinnate(v)
-            else:
-                self._attr[k] = v
+            # nested dicts are copied so the caller's data isn't changed through the Pinnate
+            self[k] = _as_plain(v) if isinstance(v, dict) else v
 
     def merge(self, data):
         """
@@ -125,16 +175,33 @@ class Pinnate:
         """
         for k, v in data.items():
             if isinstance(v, dict):
-                try:
-                    self._attr[k].merge(v)
-                except KeyError:
-                    self._attr[k] = Pinnate(v)
-                except AttributeError:
+                if k not in self._attr:
+                    self[k] = _as_plain(v)
+                elif isinstance(self._attr[k], (dict, Pinnate)):
+                    self._wrap(k).merge(v)
+                else:
                     raise ValueError("Invalid key '{}'".format(k))
             else:
-                if k in self._attr and isinstance(self._attr[k], self.__class__):
+                if isinstance(self._attr.get(k), (dict, Pinnate)):
                     msg = ("Key '{}' attempted to overwrite an existing Pinnate."
                             "Operation not permitted."
                             )
                     raise ValueError(msg.format(k))
-                self._attr[k] = v
+                self[k] = v
+
+
+_SLOTS = frozenset(Pinnate.__slots__)
+_set_slot = object.__setattr__
+
+
+def _wrap_list(values):
+    return [Pinnate(v) if isinstance(v, dict) else v for v in values]
+
+
+def _as_plain(value):
+    """Copy of value with any :class:`Pinnate` or dict converted to a new dict."""
+    if isinstance(value, Pinnate):
+        return value.as_dict()
+    if isinstance(value, dict):
+        return {k: _as_plain(v) for k, v in value.items()}
+    return value
@@ -0,0 +1,266 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+from enum import Enum
+import operator
+
+from foxglove.json_codec import get_codec
+from foxglove.pinnate import Pinnate
+
+
+class RecordType(Enum):
+    """What connectors yield for each record."""
+    PINNATE = 'pinnate' # :class:`foxglove.pinnate.Pinnate`
+    DICT = 'dict'
+    TUPLE = 'tuple' # values of the fields given in 'record_fields' or 'columns', in that order
+    RAW = 'raw' # bytes as stored, not deserialized
+
+
+def _is_in(field_value, values):
+    return field_value in values
+
+
+def _equal(field_value, value):
+    # True == 1 in python but a JSON true isn't the number 1
+    return isinstance(field_value, bool) == isinstance(value, bool) and field_value == value
+
+
+def _not_equal(field_value, value):
+    return not _equal(field_value, value)
+
+
+def _ordering(op):
+    """
+    Comparison that's False, not an error, for a missing field or a value of a type that can't
+    be compared, e.g. a string with a number.
+    """
+    def compare(field_value, value):
+        if field_value is None:
+            return False
+        try:
+            return op(field_value, value)
+        except TypeError:
+            return False
+    return compare
+
+
+class RecordFilter:
+    """
+    Decide if a record should be kept.
+
+    `where` can be-
+        dict : field -> value, keep records where all fields equal their values
+        list : of (field, operator, value) tuples, all must be true. operator is one of
+               :attr:`OPERATORS`. Items in the list can also be callables, see below.
+        callable : given the deserialized record (a dict), returns True to keep it
+
+    Fields are top level keys in the record or dot separated keys for nested fields, e.g.
+    'habitat.terrain'. A missing field has the value None. Ordering operators, e.g. '<', are
+    False for a missing field or a value that can't be compared with theirs.
+
+    >>> f = RecordFilter([('where', '==', 'Australia'), ('legs', '<', 4)])
+    >>> f.matches({'name': 'Box jellyfish', 'where': 'Australia', 'legs': 0})
+    True
+
+    Before a record is deserialized, :method:`might_match` can cheaply reject it when the
+    serialized record doesn't contain a value that an '==' condition needs. This assumes
+    plain ASCII characters in strings aren't needlessly escaped, which JSON encoders don't do.
+    """
+    OPERATORS = {'==': _equal,
+                 '!=': _not_equal,
+                 '<': _ordering(operator.lt),
+                 '<=': _ordering(operator.le),
+                 '>': _ordering(operator.gt),
+                 '>=': _ordering(operator.ge),
+                 'in': _is_in,
+                 }
+
+    # ASCII characters that an encoder could escape
+    _ESCAPABLE = set('"\\/<>&')
+
+    def __init__(self, where):
+        """
+        :param where: (dict, list or callable) see class docs
+        """
+        if isinstance(where, dict):
+            where = [(field, '==', value) for field, value in where.items()]
+        elif callable(where):
+            where = [where]
+
+        self.conditions = [] # (list of str) path to field, operator function, value
+        self.callables = []
+        self.required_tokens = [] # str, all must be in a serialized record if it can match
+        for condition in where:
+            if callable(condition):
+                self.callables.append(condition)
+                continue
+
+            field, op, value = condition
+            if op not in self.OPERATORS:
+                raise ValueError(f"Unknown operator: {op}")
+            path = field.split('.')
+            self.conditions.append((path, self.OPERATORS[op], value))
+            if op == '==':
+                self.required_tokens.extend(self._tokens(path[-1], value))
+
+        self._required_bytes = [t.encode('utf-8') for t in self.required_tokens]
+
+    @classmethod
+    def _tokens(cls, key, value):
+        """
+        Strings that must be found in a serialized record where `key` has `value`.
+        """
+        if value is None:
+            # a missing key also matches
+            return []
+        tokens = []
+        if cls._is_plain(key):
+            tokens.append(f'"{key}"')
+        if isinstance(value, bool):
+            tokens.append('true' if value else 'false')
+        elif isinstance(value, int):
+            tokens.append(str(value))
+        elif isinstance(value, str) and cls._is_plain(value):
+            tokens.append(f'"{value}"')
+        return tokens
+
+    @classmethod
+    def _is_plain(cls, s):
+        """True if `s` is always serialized to JSON as itself"""
+        return s.isascii() and s.isprintable() and not cls._ESCAPABLE.intersection(s)
+
+    def might_match(self, raw) -> bool:
+        """
+        :param raw: (bytes or str) serialized record
+        :returns: False if the record can't match, True if it might.
+        """
+        tokens = self._required_bytes if isinstance(raw, bytes) else self.required_tokens
+        for token in tokens:
+            if token not in raw:
+                return False
+        return True
+
+    def matches(self, doc) -> bool:
+        """
+        :param doc: (dict) deserialized record
+        """
+        for path, op, value in self.conditions:
+            field_value = doc
+            for key in path:
+                field_value = field_value.get(key) if isinstance(field_value, dict) else None
+            if not op(field_value, value):
+                return False
+
+        for condition in self.callables:
+            if not condition(doc):
+                return False
+        return True
+
+
+class RecordDecoder:
+    """
+    Turn a serialized record, e.g. an ndjson line or a Kafka message value, into the
+    :class:`RecordType` a connector yields.
+
+    >>> decoder = RecordDecoder(record_type='tuple', fields=['name', 'where'])
+    >>> decoder.decode(b'{"name": "Adder", "where": "United Kingdom", "legs": 0}')
+    ('Adder', 'United Kingdom')
+    """
+    def __init__(self, codec=None, record_type=RecordType.PINNATE, fields=None, columns=None,
+                 where=None):
+        """
+        :param codec: (:class:`foxglove.json_codec.JsonCodec` or
+                :class:`foxglove.deserializers.Deserializer`) default is the default
+                JSON codec, see :func:`foxglove.json_codec.get_codec`.
+        :param record_type: (:class:`RecordType` or str value of one)
+        :param fields: (list of str) for RecordType.TUPLE, default is `columns`
+        :param columns: (list of str) optional, top level fields to keep. Others are dropped as
+                soon as the record is deserialized.
+        :param where: optional, only records matching this are kept by :method:`decode_all`.
+                See :class:`RecordFilter`.
+        """
+        self.codec = codec or get_codec()
+        self.record_type = RecordType(record_type)
+        self.fields = fields
+        self.columns = columns
+        self.where = where
+        self._filter = RecordFilter(where) if where else None
+
+        if self.record_type == RecordType.TUPLE and not (self.fields or self.columns):
+            raise ValueError("'record_fields' or 'columns' are needed for tuple records")
+        if self.record_type == RecordType.RAW and self.columns:
+            raise ValueError("'columns' can't be used with raw records")
+
+    def derive(self, **kwargs) -> 'RecordDecoder':
+        """
+        :returns: new :class:`RecordDecoder` with the same settings as this except for those
+                  given in kwargs.
+        """
+        settings = dict(codec=self.codec, record_type=self.record_type, fields=self.fields,
+                        columns=self.columns, where=self.where)
+        settings.update(kwargs)
+        return self.__class__(**settings)
+
+    def decode_all(self, raws):
+        """
+        Generator yielding records from an iterable of serialized records, skipping any that
+        don't match `where`.
+        """
+        record_filter = self._filter
+        if record_filter is None:
+            yield from map(self.decode, raws)
+            return
+
+        loads = self.codec.loads
+        prefilter = self.codec.is_json
+        for raw in raws:
+            if prefilter and not record_filter.might_match(raw):
+                continue
+            doc = loads(raw)
+            if not record_filter.matches(doc):
+                continue
+            yield raw if self.record_type == RecordType.RAW else self.from_parsed(doc)
+
+    def from_parsed_all(self, docs):
+        """
+        Generator like :method:`decode_all` for records that are already deserialized.
+        """
+        record_filter = self._filter
+        for doc in docs:
+            if record_filter is None or record_filter.matches(doc):
+                yield self.from_parsed(doc)
+
+    @property
+    def needed_columns(self):
+        """
+        (list of str) fields needed to make records or None for all fields.
+        """
+        if self.where:
+            return None
+        if self.record_type == RecordType.TUPLE:
+            return self.fields or self.columns
+        return self.columns
+
+    def decode(self, raw):
+        """
+        :param raw: (bytes or str) one serialized record. `where` isn't applied.
+        """
+        if self.record_type == RecordType.RAW:
+            return raw
+        return self.from_parsed(self.codec.loads(raw))
+
+    def from_parsed(self, doc):
+        """
+        :param doc: (dict) a deserialized record
+        """
+        if self.record_type == RecordType.TUPLE:
+            return tuple(doc.get(f) for f in self.fields or self.columns)
+        if self.columns:
+            doc = {k: doc[k] for k in self.columns if k in doc}
+        if self.record_type == RecordType.PINNATE:
+            return Pinnate(doc)
+        if self.record_type == RecordType.DICT:
+            return doc
+        raise ValueError(f"Can't make {self.record_type} from a deserialized record")
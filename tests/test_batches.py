@@ -0,0 +1,36 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+import pytest
+
+from foxglove.batches import rows_to_batches
+
+ROWS = [{'name': 'Adder', 'legs': 0, 'habitats': ['heath']},
+        {'name': 'Badger', 'legs': 4, 'habitats': ['woodland', 'farmland']},
+        {'name': 'Crab', 'legs': 10},
+        ]
+
+
+def test_numpy_batches():
+    numpy = pytest.importorskip('numpy')
+    batches = list(rows_to_batches(ROWS, 2))
+    assert len(batches) == 2
+    assert list(batches[0]) == ['name', 'legs', 'habitats']
+    assert batches[0]['legs'].dtype == numpy.int64
+    # lists of different lengths can only be stored as python objects
+    assert batches[0]['habitats'].dtype == object
+    assert batches[0]['habitats'][1] == ['woodland', 'farmland']
+    assert list(batches[1]) == ['name', 'legs']
+
+def test_arrow_batches():
+    pytest.importorskip('pyarrow')
+    batches = list(rows_to_batches(ROWS, 10, columns=['name', 'habitats'], batch_format='arrow'))
+    assert len(batches) == 1
+    assert batches[0].to_pydict() == {'name': ['Adder', 'Badger', 'Crab'],
+                                      'habitats': [['heath'], ['woodland', 'farmland'], None]}
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        list(rows_to_batches(ROWS, 10, batch_format='csv'))
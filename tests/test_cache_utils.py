@@ -0,0 +1,25 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+import os
+
+from foxglove.connectors.cache_utils import cache_key, evict_least_recently_used, touch
+
+
+def test_cache_key():
+    assert cache_key('a', 1) == cache_key('a', 1)
+    assert cache_key('a', 1) != cache_key('a1')
+
+def test_evict_least_recently_used(tmp_path):
+    for i, name in enumerate(['a.arrow', 'b.arrow', 'c.arrow', 'other.txt']):
+        path = tmp_path / name
+        path.write_bytes(b'x' * 10)
+        os.utime(str(path), (i, i))
+
+    # a is used most recently
+    touch(str(tmp_path / 'a.arrow'))
+    deleted = evict_least_recently_used(str(tmp_path), 20, suffix='.arrow')
+    assert [os.path.basename(p) for p in deleted] == ['b.arrow']
+    assert sorted(os.listdir(str(tmp_path))) == ['a.arrow', 'c.arrow', 'other.txt']
@@ -0,0 +1,20 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+from foxglove.connectors.checkpoints import SqliteCheckpointStore
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'checkpoints.sqlite')
+    store = SqliteCheckpointStore(path)
+    assert store.load('model', 'topic') == {}
+    store.save('model', 'topic', {0: 10, 1: 20})
+    store.save('model', 'topic', {1: 25})
+    store.save('other_model', 'topic', {0: 5})
+    store.close()
+
+    store = SqliteCheckpointStore(path)
+    assert store.load('model', 'topic') == {0: 10, 1: 25}
+    assert store.load('other_model', 'topic') == {0: 5}
@@ -3,6 +3,7 @@
 Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
+import io
 import os
 import tarfile
 from unittest import mock
@@ -12,33 +13,76 @@ import pytest
 from google.auth.compute_engine import credentials
 from google.cloud.storage import Bucket, Blob
 
+from foxglove.connect import Connect
 from foxglove.connectors.base import AccessMode
-from foxglove.connectors.gcs_flowerpot import GcsFlowerpotConnector
-from foxglove.connectors.flowerpot import FlowerpotEngine, FlowerPotConnector
+from foxglove.connectors.gcs_flowerpot import GcsFlowerpotConnector, clear_gcs_pool
+from foxglove.connectors.flowerpot import FlowerpotEngine, FlowerpotIndex, FlowerPotConnector
 
 EXAMPLE_FLOWERPOT_PATH = os.path.dirname(os.path.abspath(__file__))\
     +'/../integration-tests/exampleflowerpot.tar.gz'
 
 EXAMPLE_ENGINE_URL = 'gs+flowerpot://fake_flowerpot_bucket/some_file.json'
 
+@pytest.fixture(autouse=True)
+def empty_gcs_pool():
+    # clients in the pool would outlive each test's patched storage.Client
+    clear_gcs_pool()
+    yield
+    clear_gcs_pool()
+
+
 @pytest.fixture
 def fake_bucket():
     return Mock(spec=Bucket)
 
 
-@pytest.fixture
-def fake_flowerpot_bucket():
+class SequentialReader(io.RawIOBase):
+    """
+    Like the google-cloud-storage BlobReader, reads a file in chunks but only sequentially.
+    """
+    def __init__(self, path, chunk_size=1024):
+        self._file = open(path, 'rb')
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(min(len(buffer), self.chunk_size))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def _fake_flowerpot_bucket(flowerpot_path):
     def fake_object_download(file_handle):
-        original_file = open(EXAMPLE_FLOWERPOT_PATH, 'rb')
+        original_file = open(flowerpot_path, 'rb')
         file_handle.write(original_file.read())
 
     bucket = Mock(spec=Bucket)
     blob = Mock(spec=Blob)
-    blob.download_to_file = fake_object_download
+    blob.download_to_file.side_effect = fake_object_download
+    blob.readers = []
+
+    def fake_object_open(mode, chunk_size=1024):
+        blob.readers.append(SequentialReader(flowerpot_path, chunk_size))
+        return blob.readers[-1]
+
+    blob.open.side_effect = fake_object_open
     bucket.get_blob.return_value = blob
     return bucket
 
 
+@pytest.fixture
+def fake_flowerpot_bucket():
+    return _fake_flowerpot_bucket(EXAMPLE_FLOWERPOT_PATH)
+
+
 @patch('google.cloud.storage.Client')
 def test_valid_flowerpot_init(fake_storage_client, fake_flowerpot_bucket):
     fake_bucket = fake_flowerpot_bucket
@@ -77,6 +121,50 @@ def test_gcs_flowerpot_data(fake_storage_client, fake_flowerpot_bucket):
     assert len(all_data) == 4
 
 
+@patch('google.cloud.storage.Client')
+def test_gcs_flowerpot_stream(fake_storage_client, tmp_path):
+    contents = {f'test_a_{i}.ndjson': b''.join(b'{"file": %d, "n": %d}\n' % (i, n)
+                                              for n in range(5000))
+                for i in range(3)}
+    flowerpot_path = _make_flowerpot(tmp_path, contents)
+    fake_bucket = _fake_flowerpot_bucket(flowerpot_path)
+    fake_storage_client.return_value.get_bucket.return_value = fake_bucket
+
+    connector = GcsFlowerpotConnector(engine_url=EXAMPLE_ENGINE_URL, stream=True,
+                                      chunk_size=4096)
+    records = iter(connector)
+    assert next(records).as_dict() == {'file': 0, 'n': 0}
+    blob = fake_bucket.get_blob.return_value
+    blob.download_to_file.assert_not_called()
+    blob.open.assert_called_once_with('rb', chunk_size=4096)
+    # records are available before the whole flowerpot has been read
+    assert blob.readers[0].bytes_read < os.path.getsize(flowerpot_path) / 2
+    assert sum(1 for _ in records) == 3 * 5000 - 1
+
+    # each read streams the flowerpot again
+    assert [r.n for r in connector.data][-1] == 4999
+    assert blob.open.call_count == 2
+
+
+@patch('google.cloud.storage.Client')
+def test_gcs_flowerpot_download_cache(fake_storage_client, fake_flowerpot_bucket, tmp_path):
+    fake_storage_client.return_value.get_bucket.return_value = fake_flowerpot_bucket
+    blob = fake_flowerpot_bucket.get_blob.return_value
+    blob.generation = 1
+    cache_dir = str(tmp_path / 'cache')
+
+    for _ in range(2):
+        connector = GcsFlowerpotConnector(engine_url=EXAMPLE_ENGINE_URL, cache_dir=cache_dir)
+        assert len(list(connector.data)) == 4
+    assert blob.download_to_file.call_count == 1
+    assert connector.download_cache.stats == {'hits': 1, 'misses': 1}
+
+    blob.generation = 2
+    connector = GcsFlowerpotConnector(engine_url=EXAMPLE_ENGINE_URL, cache_dir=cache_dir)
+    assert len(list(connector.data)) == 4
+    assert blob.download_to_file.call_count == 2
+
+
 @pytest.fixture
 def mock_credentials():
     return mock.Mock(spec=google.auth.credentials.Credentials)
@@ -96,11 +184,29 @@ def test_gcs_credentials_passed_to_client(fake_storage_client: MagicMock):
     fake_credentials = credentials.Credentials()
     project = 'some_project'
     engine_url = f'gs+flowerpot://{project}.fake_flowerpot_bucket/some_file.json'
-    GcsFlowerpotConnector(engine_url=engine_url,
-                          access=AccessMode.READ,
-                          credentials=fake_credentials)
+    connector = GcsFlowerpotConnector(engine_url=engine_url,
+                                      access=AccessMode.READ,
+                                      credentials=fake_credentials)
+    # bucket is looked up when needed
+    fake_storage_client.assert_not_called()
+    assert connector.bucket
     fake_storage_client.assert_called_with(project, fake_credentials)
 
+
+@patch('google.cloud.storage.Client')
+def test_gcs_clients_and_buckets_shared(fake_storage_client, fake_flowerpot_bucket):
+    fake_storage_client.return_value.get_bucket.return_value = fake_flowerpot_bucket
+    fake_credentials = credentials.Credentials()
+    for _ in range(3):
+        connector = GcsFlowerpotConnector(engine_url=EXAMPLE_ENGINE_URL,
+                                          credentials=fake_credentials)
+        assert len(list(connector.data)) == 4
+    fake_storage_client.assert_called_once()
+    fake_storage_client.return_value.get_bucket.assert_called_once_with('fake_flowerpot_bucket')
+
+    GcsFlowerpotConnector(engine_url=EXAMPLE_ENGINE_URL, credentials=None).connect()
+    assert fake_storage_client.call_count == 2
+
 def test_flowerpot_all_items():
     """
     Iterate all the data items in all the files in the example flowerpot.
@@ -121,3 +227,249 @@ def test_flowerpot_query_one_file():
     expected = "[('anchor', 'rudder'), ('apple', 'raspberry')]"
     assert expected == str(some_items)
 
+def _make_flowerpot(tmp_path, files):
+    """
+    Write a flowerpot to `tmp_path`.
+    Args:
+        files: (dict) file name within flowerpot -> (bytes) contents
+    Returns:
+        (str) path to flowerpot
+    """
+    flowerpot_path = str(tmp_path / 'test.flowerpot')
+    with tarfile.open(flowerpot_path, 'w:gz') as tf:
+        for file_name, contents in files.items():
+            tar_info = tarfile.TarInfo(name=file_name)
+            tar_info.size = len(contents)
+            tf.addfile(tar_info, io.BytesIO(contents))
+    return flowerpot_path
+
+def test_flowerpot_streaming_matches_full_read():
+    with tarfile.open(EXAMPLE_FLOWERPOT_PATH, 'r:gz') as tf:
+        reader = FlowerpotEngine(tf)
+        streamed = [r.as_dict() for r in reader.items(streaming=True)]
+        full_read = [r.as_dict() for r in reader.items(streaming=False)]
+    assert len(streamed) == 4
+    assert streamed == full_read
+
+def test_flowerpot_streaming_blank_lines(tmp_path):
+    """
+    Blank lines, including a trailing newline, aren't records.
+    """
+    contents = b'{"a": 1}\n\n{"a": 2}\n  \n{"a": 3}\n'
+    flowerpot_path = _make_flowerpot(tmp_path, {'things_0.ndjson': contents})
+    c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path)
+    assert [r.a for r in c] == [1, 2, 3]
+
+def test_flowerpot_index_reused(tmp_path):
+    """
+    The index is built on first use, saved next to the flowerpot and used without scanning
+    the tarball afterwards.
+    """
+    contents = {'test_a_0.ndjson': b'{"a": 1}\n{"a": 2}\n',
+                'test_a_1.ndjson': b'{"a": 3}\n',
+                'test_b_0.ndjson': b'{"b": 1}\n',
+                }
+    flowerpot_path = _make_flowerpot(tmp_path, contents)
+    c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path)
+    assert len(c) == 4
+    assert os.path.exists(flowerpot_path + FlowerpotIndex.index_suffix)
+
+    with patch.object(FlowerpotIndex, 'build') as build, \
+         patch.object(tarfile.TarFile, 'getmembers') as getmembers:
+        c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path)
+        assert c.flowerpot.file_names == list(contents.keys())
+        assert [r.a for r in c.query(table='test_a')] == [1, 2, 3]
+        build.assert_not_called()
+        getmembers.assert_not_called()
+
+def test_flowerpot_index_rebuilt_when_stale(tmp_path):
+    flowerpot_path = _make_flowerpot(tmp_path, {'test_a_0.ndjson': b'{"a": 1}\n'})
+    assert FlowerpotIndex.for_filename(flowerpot_path).file_names == ['test_a_0.ndjson']
+
+    _make_flowerpot(tmp_path, {'test_a_0.ndjson': b'{"a": 1}\n{"a": 2}\n',
+                               'test_b_0.ndjson': b'{"b": 1}\n'})
+    os.utime(flowerpot_path, (0, 0))
+    index = FlowerpotIndex.for_filename(flowerpot_path)
+    assert index.file_names == ['test_a_0.ndjson', 'test_b_0.ndjson']
+    assert index.records('test_a_0.ndjson') == 2
+
+def test_flowerpot_without_index():
+    c = FlowerPotConnector(engine_url="flowerpot://"+EXAMPLE_FLOWERPOT_PATH, use_index=False)
+    assert len(list(c.data)) == 4
+    with pytest.raises(NotImplementedError):
+        len(c)
+
+@pytest.mark.parametrize('use_index', [True, False])
+def test_flowerpot_parallel_items(tmp_path, use_index):
+    contents = {f'test_a_{i}.ndjson': b''.join(b'{"a": %d}\n' % (i*10+j) for j in range(10))
+                for i in range(6)}
+    flowerpot_path = _make_flowerpot(tmp_path, contents)
+    sequential = [r.a for r in FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path)]
+
+    c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path, use_index=use_index,
+                           processes=2, max_in_flight=3)
+    assert [r.a for r in c] == sequential
+
+    c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path, use_index=use_index,
+                           processes=2, ordered=False)
+    assert sorted(r.a for r in c.query(table='test_a')) == sorted(sequential)
+
+def test_flowerpot_parallel_without_filename():
+    """
+    Workers are sent each file's contents so don't need to open the flowerpot themselves.
+    """
+    with open(EXAMPLE_FLOWERPOT_PATH, 'rb') as f:
+        reader = FlowerpotEngine.from_file(f)
+        parallel = [r.as_dict() for r in reader.items(processes=2)]
+    assert parallel == [r.as_dict() for r in FlowerpotEngine.from_filename(
+        EXAMPLE_FLOWERPOT_PATH, use_index=False).items()]
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_flowerpot_record_types(processes):
+    engine_url = "flowerpot://"+EXAMPLE_FLOWERPOT_PATH
+    c = FlowerPotConnector(engine_url=engine_url, record_type='dict', processes=processes)
+    assert {"availability": "apple", "referential": "raspberry"} in list(c)
+
+    c = FlowerPotConnector(engine_url=engine_url, record_type='tuple', processes=processes,
+                           record_fields=['referential', 'availability'])
+    assert ('raspberry', 'apple') in list(c.query(table='test_a'))
+
+    c = FlowerPotConnector(engine_url=engine_url, record_type='raw', processes=processes)
+    assert all(isinstance(r, bytes) and not r.endswith(b'\n') for r in c)
+
+def test_flowerpot_record_type_via_connect():
+    c = Connect(engine_url="flowerpot://"+EXAMPLE_FLOWERPOT_PATH, record_type='dict')
+    assert all(isinstance(r, dict) for r in c)
+
+def test_flowerpot_query_columns():
+    c = FlowerPotConnector(engine_url="flowerpot://"+EXAMPLE_FLOWERPOT_PATH)
+    some_items = [r.as_dict() for r in c.query(table='test_a', columns=['referential'])]
+    assert some_items == [{'referential': 'raspberry'}, {'referential': 'rudder'}]
+
+    # without table, all files
+    assert len([r for r in c.query(columns=['referential'])]) == 4
+
+    c = FlowerPotConnector(engine_url="flowerpot://"+EXAMPLE_FLOWERPOT_PATH,
+                           columns=['availability'], record_type='dict')
+    assert all(list(r.keys()) == ['availability'] for r in c)
+
+def test_flowerpot_query_unknown_option():
+    c = FlowerPotConnector(engine_url="flowerpot://"+EXAMPLE_FLOWERPOT_PATH)
+    with pytest.raises(NotImplementedError):
+        c.query(sql='SELECT 1')
+
+def _is_rudder(row):
+    return row['referential'] == 'rudder'
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_flowerpot_query_where(processes):
+    c = FlowerPotConnector(engine_url="flowerpot://"+EXAMPLE_FLOWERPOT_PATH, processes=processes)
+    assert [r.referential for r in c.query(where={'availability': 'apple'})] == ['raspberry']
+    rows = c.query(table='test_b', where=[('availability', 'in', ['antenna', 'acoustic'])],
+                   columns=['referential'])
+    assert sorted(r.referential for r in rows) == ['rap', 'receive']
+    assert [r.availability for r in c.query(where=_is_rudder)] == ['anchor']
+
+def test_flowerpot_query_empty_options():
+    c = FlowerPotConnector(engine_url="flowerpot://"+EXAMPLE_FLOWERPOT_PATH)
+    assert len(list(c.query(where={}, columns=[]))) == 4
+
+def test_flowerpot_columnar_cache(tmp_path):
+    pytest.importorskip('pyarrow')
+    contents = {'test_a_0.ndjson': b'{"a": 1, "b": "x"}\n{"a": 2, "c": [1, 2]}\n',
+                'test_b_0.ndjson': b'{"b": "y"}\n'}
+    flowerpot_path = _make_flowerpot(tmp_path, contents)
+    cache_dir = str(tmp_path / 'cache')
+    engine_url = "flowerpot://"+flowerpot_path
+
+    first_read = [r.as_dict() for r in FlowerPotConnector(engine_url=engine_url,
+                                                          cache_dir=cache_dir)]
+    assert len(os.listdir(cache_dir)) == 2
+    # records from the cache are the same as those in the flowerpot
+    assert first_read == [{'a': 1, 'b': 'x'}, {'a': 2, 'c': [1, 2]}, {'b': 'y'}]
+
+    with patch.object(FlowerpotEngine, '_ndjson_lines') as ndjson_lines:
+        c = FlowerPotConnector(engine_url=engine_url, cache_dir=cache_dir)
+        assert [r.as_dict() for r in c] == first_read
+        assert [r.a for r in c.query(table='test_a', columns=['a'])] == [1, 2]
+        assert [r.b for r in c.query(where={'a': 1})] == ['x']
+        ndjson_lines.assert_not_called()
+
+def test_flowerpot_columnar_cache_unconvertable(tmp_path):
+    """
+    Files that can't be stored in a columnar format are read as usual.
+    """
+    pytest.importorskip('pyarrow')
+    flowerpot_path = _make_flowerpot(tmp_path, {'test_a_0.ndjson': b'{"a": 1}\n{"a": "one"}\n'})
+    cache_dir = str(tmp_path / 'cache')
+    c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path, cache_dir=cache_dir)
+    assert [r.a for r in c] == [1, 'one']
+    assert os.listdir(cache_dir) == []
+
+def test_flowerpot_columnar_cache_number_types(tmp_path):
+    """
+    Ints aren't turned into floats by the cache.
+    """
+    pytest.importorskip('pyarrow')
+    contents = {'test_a_0.ndjson': b'{"a": 1}\n{"a": 2.5}\n',
+                'test_b_0.ndjson': b'{"a": 1, "b": null}\n{"a": 2}\n',
+                'test_c_0.ndjson': b'{"a": [1, 2.5]}\n'}
+    flowerpot_path = _make_flowerpot(tmp_path, contents)
+    cache_dir = str(tmp_path / 'cache')
+    expected = [{'a': 1}, {'a': 2.5}, {'a': 1, 'b': None}, {'a': 2}, {'a': [1, 2.5]}]
+    for _ in range(2):
+        c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path, cache_dir=cache_dir,
+                               record_type='dict')
+        rows = list(c)
+        assert rows == expected
+        assert [type(r['a']) for r in rows[:4]] == [int, float, int, int]
+        assert type(rows[4]['a'][0]) == int
+    # only the file with the same type throughout is cached
+    assert len(os.listdir(cache_dir)) == 1
+
+def test_flowerpot_columnar_cache_eviction(tmp_path):
+    pytest.importorskip('pyarrow')
+    contents = {f'test_a_{i}.ndjson': b'{"a": %d}\n' % i for i in range(3)}
+    flowerpot_path = _make_flowerpot(tmp_path, contents)
+    cache_dir = str(tmp_path / 'cache')
+    c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path, cache_dir=cache_dir)
+    list(c.data)
+    table_size = max(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir))
+
+    c = FlowerPotConnector(engine_url="flowerpot://"+flowerpot_path,
+                           cache_dir=str(tmp_path / 'small'), cache_max_bytes=table_size * 2)
+    assert [r.a for r in c] == [0, 1, 2]
+    assert len(os.listdir(str(tmp_path / 'small'))) == 2
+
+
+def test_flowerpot_batches(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    contents = {'test_a_0.ndjson': b'{"a": 1, "b": "x"}\n{"a": 2, "c": [1, 2]}\n',
+                'test_a_1.ndjson': b'{"a": 3, "b": "y"}\n'}
+    c = FlowerPotConnector(engine_url="flowerpot://"+_make_flowerpot(tmp_path, contents))
+    batches = list(c.batches(batch_size=2, columns=['a', 'b']))
+    assert [list(b['a']) for b in batches] == [[1, 2], [3]]
+    assert list(batches[0]['b']) == ['x', None]
+    assert batches[0]['a'].dtype == numpy.int64
+
+    c = FlowerPotConnector(engine_url="flowerpot://"+_make_flowerpot(tmp_path, contents),
+                           cache_dir=str(tmp_path / 'cache'))
+    pytest.importorskip('pyarrow')
+    # batches from the cache don't span files
+    batches = list(c.batches(batch_size=2, columns=['a'], batch_format='arrow'))
+    assert [b.column('a').to_pylist() for b in batches] == [[1, 2], [3]]
+    assert batches[0].schema.names == ['a']
+    batches = list(c.batches(batch_format='numpy'))
+    assert batches[0]['a'].sum() == 3
+    assert list(batches[0]['c'][1]) == [1, 2]
+
+def test_flowerpot_from_stream(tmp_path):
+    contents = {'test_a_0.ndjson': b'{"a": 1}\n\n{"a": 2}\n', 'test_b_0.ndjson': b'{"a": 3}\n'}
+    flowerpot_path = _make_flowerpot(tmp_path, contents)
+    with SequentialReader(flowerpot_path) as f:
+        engine = FlowerpotEngine.from_stream(f)
+        with pytest.raises(ValueError):
+            engine.file_names
+        assert [r.a for r in engine.items(file_name='test_b_0.ndjson')] == [3]
+    with SequentialReader(flowerpot_path) as f:
+        assert [r.a for r in FlowerpotEngine.from_stream(f).items()] == [1, 2, 3]
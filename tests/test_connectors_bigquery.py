@@ -3,12 +3,21 @@
 Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
-from unittest.mock import Mock
+import gzip
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
 
 import pytest
 from google.cloud.bigquery import Client
 
 from foxglove.connectors.bigquery import BigQueryConnector
+from foxglove.connectors.flowerpot import FlowerpotEngine, FlowerPotConnector
 
 
 @pytest.fixture
@@ -80,3 +89,338 @@ def test_sql_query_with_params():
     for row in connector.query(sql=sql, sql_params=[("my_pid", "STRING", "b01qw8tz")]):
         assert row.id == 1
 
+
+WRITE_ENGINE_URL = 'bigquery://projectId=my_project;datasetId=nice_food;tableId=cakes;'
+EXAMPLE_FLOWERPOT_PATH = os.path.dirname(os.path.abspath(__file__))\
+    +'/../integration-tests/exampleflowerpot.tar.gz'
+
+def _slow_inserts(connector, delay=0.05):
+    """
+    Replace connector's client with a fake recording rows inserted and the most inserts that
+    happened at the same time.
+    """
+    connector.client = Mock()
+    inserted = []
+    in_flight = []
+    most_in_flight = [0]
+    lock = threading.Lock()
+
+    def insert_rows(table, rows):
+        with lock:
+            in_flight.append(rows)
+            most_in_flight[0] = max(most_in_flight[0], len(in_flight))
+        time.sleep(delay)
+        with lock:
+            in_flight.remove(rows)
+            inserted.append(rows)
+        return []
+
+    connector.client.insert_rows.side_effect = insert_rows
+    return inserted, most_in_flight
+
+def test_background_writes():
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, write_max_rows=10,
+                                  write_max_in_flight=3)
+    inserted, most_in_flight = _slow_inserts(connector)
+    start = time.perf_counter()
+    for i in range(95):
+        connector.add({'id': i})
+    # rows are added while batches are sent
+    assert time.perf_counter() - start < 0.05 * 9
+    connector.flush_writes()
+    assert sorted(r['id'] for rows in inserted for r in rows) == list(range(95))
+    assert sorted(len(rows) for rows in inserted) == [5] + [10] * 9
+    assert most_in_flight[0] == 3
+
+def test_write_batches_limited_by_bytes():
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, write_max_bytes=1000,
+                                  write_max_in_flight=0)
+    inserted, most_in_flight = _slow_inserts(connector, delay=0)
+    for i in range(10):
+        connector.add({'id': i, 'text': 'x' * 240})
+    connector.flush_writes()
+    assert [len(rows) for rows in inserted] == [4, 4, 2]
+
+def test_background_write_errors_raised():
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, write_max_rows=1)
+    connector.client = Mock()
+    connector.client.insert_rows.side_effect = ConnectionError("Connection reset")
+    connector.add({'id': 1})
+    with pytest.raises(ConnectionError):
+        connector.flush_writes()
+
+def test_rows_kept_after_background_write_error():
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, write_max_rows=1,
+                                  write_max_in_flight=1)
+    connector.client = Mock()
+    inserted = []
+
+    def insert_rows(table, rows):
+        if rows[0]['id'] == 1:
+            raise ConnectionError("Connection reset")
+        inserted.extend(rows)
+        return []
+
+    connector.client.insert_rows.side_effect = insert_rows
+    connector.add({'id': 1})
+    with pytest.raises(ConnectionError):
+        connector.add({'id': 2})
+    assert connector.write_rows_buffer == [{'id': 2}]
+    connector.flush_writes()
+    assert inserted == [{'id': 2}]
+
+def test_every_background_write_error_raised():
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, write_max_rows=1,
+                                  write_max_in_flight=3)
+    connector.client = Mock()
+    errors = {0: ConnectionError("reset"), 2: TimeoutError("timed out")}
+
+    def insert_rows(table, rows):
+        time.sleep(0.1)
+        if rows[0]['id'] in errors:
+            raise errors[rows[0]['id']]
+        return []
+
+    connector.client.insert_rows.side_effect = insert_rows
+    for i in range(3):
+        connector.add({'id': i})
+    with pytest.raises(ValueError) as e:
+        connector.flush_writes()
+    assert 'ConnectionError: reset' in str(e.value)
+    assert 'TimeoutError: timed out' in str(e.value)
+
+def test_write_errors_retried(tmp_path):
+    dead_letter_file = str(tmp_path / 'dead_letters.ndjson')
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, write_max_in_flight=0,
+                                  write_retry_delay_s=0, write_max_retries=2,
+                                  dead_letter_file=dead_letter_file)
+    connector.client = Mock()
+    sent = []
+
+    def insert_rows(table, rows):
+        sent.append([r['id'] for r in rows])
+        errors = []
+        for index, row in enumerate(rows):
+            if row['id'] == 'bad':
+                errors.append({'index': index, 'errors': [{'reason': 'invalid'}]})
+            elif row['id'] == 'flaky' and len(sent) == 1:
+                errors.append({'index': index, 'errors': [{'reason': 'backendError'}]})
+            elif row['id'] == 'down':
+                errors.append({'index': index, 'errors': [{'reason': 'timeout'}]})
+        return errors
+
+    connector.client.insert_rows.side_effect = insert_rows
+    for row_id in ['ok', 'bad', 'flaky', 'down']:
+        connector.add({'id': row_id})
+    connector.flush_writes()
+
+    # only failed rows are sent again
+    assert sent == [['ok', 'bad', 'flaky', 'down'], ['flaky', 'down'], ['down']]
+    assert connector.write_stats == {'sent': 2, 'retried': 3, 'failed': 2}
+    with open(dead_letter_file) as f:
+        dead_letters = [json.loads(line) for line in f]
+    assert [d['row']['id'] for d in dead_letters] == ['bad', 'down']
+    assert dead_letters[1]['errors'] == [{'reason': 'timeout'}]
+
+
+def _fake_load_jobs(connector, delay=0):
+    """
+    Replace the connector's client. :returns: list of (write disposition, rows) loaded
+    """
+    connector.client = Mock()
+    loads = []
+
+    def load_table_from_file(file_obj, destination, job_config):
+        # read in parts, like an upload, so concurrent jobs' reads interleave
+        data = b''
+        for part in iter(lambda: file_obj.read(16384), b''):
+            data += part
+            time.sleep(0.001)
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        rows = [json.loads(line) for line in data.splitlines() if line.strip()]
+        job = Mock()
+
+        def result():
+            time.sleep(delay)
+            loads.append((job_config.write_disposition, rows))
+
+        job.result.side_effect = result
+        return job
+
+    connector.client.load_table_from_file.side_effect = load_table_from_file
+    return loads
+
+
+def test_write_rows_load_jobs():
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, load_chunk_bytes=30)
+    loads = _fake_load_jobs(connector)
+    rows = [{'id': i, 'name': f"row {i}"} for i in range(5)]
+
+    jobs = connector.write_rows(iter(rows))
+
+    assert len(jobs) == 3
+    # truncate is loaded first, alone
+    assert loads[0] == ('WRITE_TRUNCATE', rows[:2])
+    assert {d for d, _ in loads[1:]} == {'WRITE_APPEND'}
+    assert sorted(r['id'] for _, chunk in loads for r in chunk) == list(range(5))
+
+
+def test_write_rows_from_flowerpot():
+    flowerpot = FlowerPotConnector(engine_url="flowerpot://" + EXAMPLE_FLOWERPOT_PATH)
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL)
+    loads = _fake_load_jobs(connector)
+    connector.write_rows(flowerpot.data)
+    assert [rows for _, rows in loads] == [[r.as_dict() for r in flowerpot.data]]
+
+
+def test_write_rows_loads_in_parallel():
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, load_chunk_bytes=1,
+                                  load_max_in_flight=4)
+    loads = _fake_load_jobs(connector, delay=0.2)
+    start = time.time()
+    connector.write_rows(({'id': i} for i in range(8)), append=True)
+    assert len(loads) == 8
+    assert time.time() - start < 1.0
+
+
+def test_transfer_files():
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, load_max_in_flight=3)
+    loads = _fake_load_jobs(connector, delay=0.2)
+    files = []
+    for i in range(7):
+        f = io.BytesIO(gzip.compress(json.dumps({'id': i}).encode('utf-8')))
+        files.append(f)
+
+    start = time.time()
+    jobs = connector.transfer_files(iter(files))
+
+    assert len(jobs) == 7
+    # one truncate then two rounds of three appends
+    assert time.time() - start < 0.2 * 5
+    assert loads[0] == ('WRITE_TRUNCATE', [{'id': 0}])
+    assert sorted(rows[0]['id'] for d, rows in loads[1:] if d == 'WRITE_APPEND') == list(range(1, 7))
+    assert all(f.closed for f in files)
+
+
+def test_transfer_files_from_flowerpot(tmp_path):
+    """
+    Files within a flowerpot share one tarball so can't be read by concurrent jobs.
+    """
+    flowerpot_path = str(tmp_path / 'many.flowerpot')
+    with tarfile.open(flowerpot_path, mode='w:gz') as tf:
+        for i in range(8):
+            contents = ''.join(json.dumps({'file': i, 'n': n}) + '\n' for n in range(5000))
+            tar_info = tarfile.TarInfo(f"test_a_{i}.ndjson")
+            tar_info.size = len(contents)
+            tf.addfile(tar_info, io.BytesIO(contents.encode('utf-8')))
+
+    flowerpot = FlowerpotEngine.from_filename(flowerpot_path)
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, load_max_in_flight=4)
+    loads = _fake_load_jobs(connector, delay=0.05)
+    handles = []
+
+    def file_handles():
+        for _, file_handle in flowerpot.file_handles():
+            handles.append(file_handle)
+            yield file_handle
+
+    with patch('foxglove.connectors.bigquery._SPOOL_MAX_BYTES', 1024):
+        jobs = connector.transfer_files(file_handles())
+    assert len(jobs) == 8
+    # files bigger than the spool size were loaded from disk, not memory
+    uploaded = [c[1]['file_obj'] for c in connector.client.load_table_from_file.call_args_list]
+    assert all(f._rolled for f in uploaded)
+    loaded = sorted((r['file'], r['n']) for _, rows in loads for r in rows)
+    assert loaded == [(i, n) for i in range(8) for n in range(5000)]
+    assert all(h.closed for h in handles)
+
+
+class StubReadSession:
+    """
+    Stands in for google.cloud.bigquery_storage.types.ReadSession
+    """
+    TableReadOptions = SimpleNamespace
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class StubReadClient:
+    """
+    Storage Read API client reading each of `streams`, a list of lists of record batches.
+    """
+    streams = []
+
+    def __init__(self, credentials=None):
+        self.sessions = []
+
+    def create_read_session(self, parent, read_session, max_stream_count):
+        self.sessions.append((parent, read_session, max_stream_count))
+        names = [f"stream_{i}" for i in range(len(self.streams))][:max_stream_count]
+        return SimpleNamespace(streams=[SimpleNamespace(name=n) for n in names])
+
+    def read_rows(self, name):
+        pages = [SimpleNamespace(to_arrow=lambda b=b: b)
+                 for b in self.streams[int(name.split('_')[1])]]
+        return SimpleNamespace(rows=lambda session: SimpleNamespace(pages=pages))
+
+
+@pytest.fixture
+def stub_bigquery_storage(monkeypatch):
+    pa = pytest.importorskip('pyarrow')
+    StubReadClient.streams = [
+        [pa.RecordBatch.from_pydict({'id': [1, 2], 'name': ['a', 'b']}),
+         pa.RecordBatch.from_pydict({'id': [3], 'name': ['c']})],
+        [pa.RecordBatch.from_pydict({'id': [4], 'name': ['d']})],
+    ]
+    module = SimpleNamespace(
+        BigQueryReadClient=StubReadClient,
+        types=SimpleNamespace(ReadSession=StubReadSession,
+                              DataFormat=SimpleNamespace(ARROW='ARROW')),
+    )
+    monkeypatch.setattr('foxglove.connectors.bigquery._bigquery_storage', lambda: module)
+    return module
+
+
+def _read_connector(**kwargs):
+    connector = BigQueryConnector(engine_url=WRITE_ENGINE_URL, **kwargs)
+    connector.project_id, connector.dataset_id, connector.table_id = connector._decode_engine_url()
+    connector.client = Mock()
+    return connector
+
+
+def test_read_api_data(stub_bigquery_storage):
+    connector = _read_connector(read_api=True, read_streams=2)
+    rows = list(connector.data)
+    assert sorted((r.id, r['name']) for r in rows) == [(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')]
+    connector.client.list_rows.assert_not_called()
+
+    parent, session, max_stream_count = connector.read_client.sessions[0]
+    assert parent == 'projects/my_project'
+    assert session.table == 'projects/my_project/datasets/nice_food/tables/cakes'
+    assert max_stream_count == 2
+
+
+def test_read_api_batches(stub_bigquery_storage):
+    connector = _read_connector(read_api=True)
+    batches = list(connector.batches(columns=['id'], batch_format='arrow'))
+    assert sorted(n for b in batches for n in b.column('id').to_pylist()) == [1, 2, 3, 4]
+    _, session, _ = connector.read_client.sessions[0]
+    assert session.read_options.selected_fields == ['id']
+
+
+def test_read_api_query(stub_bigquery_storage):
+    connector = _read_connector(read_api=True)
+    result = connector.client.query.return_value.result.return_value
+    result.to_arrow_iterable.return_value = iter(StubReadClient.streams[0])
+    rows = list(connector.query(sql='SELECT id, name FROM cakes'))
+    assert [r.id for r in rows] == [1, 2, 3]
+    result.to_arrow_iterable.assert_called_with(bqstorage_client=connector.read_client)
+
+
+def test_read_api_falls_back_without_package(monkeypatch):
+    monkeypatch.setattr('foxglove.connectors.bigquery._bigquery_storage', lambda: None)
+    connector = _read_connector(read_api=True)
+    connector.client.list_rows.return_value = iter(['row'])
+    assert list(connector.data) == ['row']
@@ -3,15 +3,134 @@
 Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
+from collections import namedtuple
 from datetime import datetime
+import io
+import json
+from unittest.mock import patch
+
+from kafka.structs import OffsetAndTimestamp
 import pytest
 
-from foxglove.connectors.kafka_connector import KafkaConnector
+from foxglove.connectors.kafka_connector import KafkaConnector, clear_metadata_cache
+from foxglove.pinnate import Pinnate
 
 EXAMPLE_ENGINE_URL_0="kafka://bionic/topic=foobar;start=@(2019-05-15 08:00:00);end=@(2019-05-15 18:00:00);"
 EXAMPLE_ENGINE_URL_1="kafka://bionic/topic=foobar;start=@(2019-05-15 15:50:18);end=@(2019-05-15 15:50:24);"
 EXAMPLE_ENGINE_URL_2="kafka://bionic/topic=uas;start=@(2019-05-22 10:42:00);end=@(2019-05-22 10:44:00);"
 
+FakeMessage = namedtuple('FakeMessage', 'topic partition offset timestamp key value')
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+FAKE_START = datetime.strptime("2019-05-15 08:00:00", DATE_FORMAT)
+
+
+class FakeKafkaConsumer:
+    """
+    Stand-in for :class:`kafka.KafkaConsumer` serving messages from memory.
+
+    Partition p has `messages_per_partition` messages, one a second starting at FAKE_START
+    with the value {"p": p, "n": offset}.
+    """
+    metadata_fetches = 0 # by all instances
+    encode = staticmethod(lambda doc: json.dumps(doc).encode()) # message value
+
+    def __init__(self, topic='foobar', partitions=3, messages_per_partition=10, **config):
+        self.config = config
+        self.topic = topic
+        self.messages = {}
+        start_ms = int(FAKE_START.timestamp() * 1000)
+        for p in range(partitions):
+            self.messages[p] = [FakeMessage(topic, p, offset, start_ms + offset * 1000,
+                                            None, self.encode({'p': p, 'n': offset}))
+                                for offset in range(messages_per_partition)]
+        # partition -> offset after the last message, when there are markers or compacted
+        # messages after it
+        self.log_end_offsets = {}
+        self.assigned = []
+        self.positions = {}
+        self.paused = set()
+        self.fetch_size = 4 # messages per partition for each poll
+
+    def topics(self):
+        FakeKafkaConsumer.metadata_fetches += 1
+        return {self.topic}
+
+    def partitions_for_topic(self, topic):
+        FakeKafkaConsumer.metadata_fetches += 1
+        return set(self.messages) if topic == self.topic else set()
+
+    def offsets_for_times(self, timestamps):
+        r = {}
+        for tp, ts in timestamps.items():
+            found = [m for m in self.messages[tp.partition] if m.timestamp >= ts]
+            r[tp] = OffsetAndTimestamp(found[0].offset, found[0].timestamp, -1) if found \
+                else None
+        return r
+
+    def end_offsets(self, partitions):
+        return {tp: self._log_end_offset(tp.partition) for tp in partitions}
+
+    def _log_end_offset(self, partition):
+        messages = self.messages[partition]
+        return self.log_end_offsets.get(partition, messages[-1].offset + 1 if messages else 0)
+
+    def beginning_offsets(self, partitions):
+        return {tp: 0 for tp in partitions}
+
+    def assign(self, partitions):
+        self.assigned = list(partitions)
+
+    def seek(self, tp, offset):
+        self.positions[tp] = offset
+
+    def poll(self, timeout_ms=0, max_records=None):
+        r = {}
+        for tp in self.assigned:
+            if tp in self.paused:
+                continue
+            position = self.positions[tp]
+            messages = [m for m in self.messages[tp.partition]
+                        if m.offset >= position][:self.fetch_size]
+            if messages:
+                r[tp] = messages
+                self.positions[tp] = messages[-1].offset + 1
+            else:
+                # skip markers at the end of the log
+                self.positions[tp] = max(position, self._log_end_offset(tp.partition))
+        return r
+
+    def position(self, tp):
+        return self.positions[tp]
+
+    def pause(self, *partitions):
+        self.paused.update(partitions)
+
+    def resume(self, *partitions):
+        self.paused.difference_update(partitions)
+
+    def __iter__(self):
+        for tp in self.assigned:
+            while self.positions[tp] < len(self.messages[tp.partition]):
+                m = self.messages[tp.partition][self.positions[tp]]
+                self.positions[tp] += 1
+                yield m
+
+
+def fake_kafka_engine_url(start_seconds, end_seconds):
+    start = datetime.fromtimestamp(FAKE_START.timestamp() + start_seconds)
+    end = datetime.fromtimestamp(FAKE_START.timestamp() + end_seconds)
+    return f"kafka://fake/topic=foobar;start=@({start:{DATE_FORMAT}});end=@({end:{DATE_FORMAT}});"
+
+
+@pytest.fixture
+def fake_kafka():
+    clear_metadata_cache()
+    FakeKafkaConsumer.metadata_fetches = 0
+    with patch('foxglove.connectors.kafka_connector.KafkaConsumer', FakeKafkaConsumer):
+        yield
+    clear_metadata_cache()
+
 def test_engine_decode():
     date_format = "%Y-%m-%d %H:%M:%S"
     c = KafkaConnector(engine_url=EXAMPLE_ENGINE_URL_0)
@@ -48,3 +167,228 @@ def test_partition_ranges_2():
     expected = {(0, 0, 91)}
     assert expected == p_ranges
 
+def test_record_types(fake_kafka):
+    engine_url = fake_kafka_engine_url(2, 5)
+    records = [r for r in KafkaConnector(engine_url=engine_url)]
+    assert all(isinstance(r, Pinnate) for r in records)
+    assert {(r.p, r.n) for r in records} >= {(p, n) for p in range(3) for n in range(2, 5)}
+
+    c = KafkaConnector(engine_url=engine_url, record_type='tuple', record_fields=['p', 'n'])
+    records = list(c.data)
+    assert (0, 2) in records
+
+    records = list(KafkaConnector(engine_url=engine_url, record_type='raw').data)
+    assert b'{"p": 0, "n": 2}' in records
+
+def test_columns(fake_kafka):
+    c = KafkaConnector(engine_url=fake_kafka_engine_url(2, 5), columns=['n'], record_type='dict')
+    assert all(r.keys() == {'n'} for r in c.data)
+
+def test_batches(fake_kafka):
+    pytest.importorskip('numpy')
+    c = KafkaConnector(engine_url=fake_kafka_engine_url(2, 5))
+    batches = list(c.batches(batch_size=5, columns=['n']))
+    assert [len(b['n']) for b in batches] == [5, 4]
+    assert sorted(n for b in batches for n in b['n']) == sorted(r.n for r in c.data)
+
+def test_concurrent_partitions(fake_kafka):
+    engine_url = fake_kafka_engine_url(1, 8)
+    one_by_one = [(r.p, r.n) for r in KafkaConnector(engine_url=engine_url)]
+
+    c = KafkaConnector(engine_url=engine_url, concurrent_partitions=True)
+    messages = list(c._messages())
+    assert sorted((m.partition, m.offset) for m in messages) == sorted(one_by_one)
+    timestamps = [m.timestamp for m in messages]
+    assert timestamps == sorted(timestamps)
+    # every partition stops at its end offset
+    assert c.client.paused == set(c.client.assigned)
+
+    c = KafkaConnector(engine_url=engine_url, concurrent_partitions=True, ordering='unordered')
+    assert sorted((r.p, r.n) for r in c) == sorted(one_by_one)
+
+    with pytest.raises(ValueError):
+        KafkaConnector(engine_url=engine_url, ordering='alphabetical')
+
+def test_consumer_tuning(fake_kafka):
+    c = KafkaConnector(engine_url=fake_kafka_engine_url(2, 5), max_poll_records=2,
+                       fetch_max_bytes=1024)
+    c.connect()
+    assert c.client.config == {'bootstrap_servers': 'fake', 'max_poll_records': 2,
+                               'fetch_max_bytes': 1024}
+
+@pytest.mark.parametrize('concurrent_partitions', [False, True])
+def test_offset_bounded_ranges(fake_kafka, concurrent_partitions):
+    # messages at 2s, 3s and 4s. The message at 5s isn't in the range.
+    c = KafkaConnector(engine_url=fake_kafka_engine_url(2, 5),
+                       concurrent_partitions=concurrent_partitions)
+    assert sorted(c._partition_ranges()) == [(0, 2, 5), (1, 2, 5), (2, 2, 5)]
+    assert sorted((r.p, r.n) for r in c) == [(p, n) for p in range(3) for n in range(2, 5)]
+
+    # range ends after the last message
+    c = KafkaConnector(engine_url=fake_kafka_engine_url(7, 60),
+                       concurrent_partitions=concurrent_partitions)
+    assert sorted(c._partition_ranges()) == [(0, 7, 10), (1, 7, 10), (2, 7, 10)]
+    assert sorted(r.n for r in c) == [7, 7, 7, 8, 8, 8, 9, 9, 9]
+
+    # no messages in range
+    c = KafkaConnector(engine_url=fake_kafka_engine_url(30, 60),
+                       concurrent_partitions=concurrent_partitions)
+    assert [r for r in c] == []
+
+class MarkerEndedKafkaConsumer(FakeKafkaConsumer):
+    """
+    Each partition's last offset is a transaction marker, not a message, so the message
+    before the end offset is never seen.
+    """
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.polls = 0
+        for p, messages in self.messages.items():
+            self.log_end_offsets[p] = len(messages)
+            self.messages[p] = messages[:-1]
+
+    def poll(self, timeout_ms=0, max_records=None):
+        self.polls += 1
+        assert self.polls < 100, "still polling after the end of the range"
+        return super().poll(timeout_ms=timeout_ms, max_records=max_records)
+
+@pytest.mark.parametrize('concurrent_partitions', [False, True])
+def test_range_ending_without_a_message(fake_kafka, concurrent_partitions):
+    with patch('foxglove.connectors.kafka_connector.KafkaConsumer', MarkerEndedKafkaConsumer):
+        c = KafkaConnector(engine_url=fake_kafka_engine_url(7, 60),
+                           concurrent_partitions=concurrent_partitions)
+        assert sorted(c._partition_ranges()) == [(0, 7, 10), (1, 7, 10), (2, 7, 10)]
+        assert sorted(r.n for r in c) == [7, 7, 7, 8, 8, 8]
+
+def test_topic_metadata_cached(fake_kafka):
+    for _ in range(3):
+        KafkaConnector(engine_url=fake_kafka_engine_url(2, 5)).connect()
+    assert FakeKafkaConsumer.metadata_fetches == 1
+
+    with pytest.raises(ValueError):
+        KafkaConnector(engine_url=fake_kafka_engine_url(2, 5).replace('foobar', 'x')).connect()
+
+def test_engine_decode_partition_offsets():
+    c = KafkaConnector(engine_url="kafka://bionic/topic=foobar;start=0:1500,1:1200;end=@(2019-05-15 18:00:00);")
+    _, _, start_params, end_params = c._decode_engine_url()
+    assert start_params == {0: 1500, 1: 1200}
+    assert end_params == datetime.strptime("2019-05-15 18:00:00", DATE_FORMAT)
+
+    c = KafkaConnector(engine_url="kafka://bionic/topic=foobar;start=0-1500;")
+    with pytest.raises(ValueError):
+        c._decode_engine_url()
+
+def test_partition_offset_ranges(fake_kafka):
+    c = KafkaConnector(engine_url="kafka://fake/topic=foobar;start=0:3,2:8;end=0:5;")
+    assert list(c._partition_ranges()) == [(0, 3, 5), (2, 8, 10)]
+    assert [(r.p, r.n) for r in c] == [(0, 3), (0, 4), (2, 8), (2, 9)]
+
+@pytest.mark.parametrize('concurrent_partitions', [False, True])
+def test_end_offset_after_log_end(fake_kafka, concurrent_partitions):
+    c = KafkaConnector(engine_url="kafka://fake/topic=foobar;start=0:3;end=0:50;",
+                       concurrent_partitions=concurrent_partitions)
+    assert list(c._partition_ranges()) == [(0, 3, 10)]
+    assert [r.n for r in c] == list(range(3, 10))
+
+    c = KafkaConnector(engine_url="kafka://fake/topic=foobar;end=@(2019-05-15 08:00:02);")
+    assert list(c._partition_ranges()) == [(0, 0, 2), (1, 0, 2), (2, 0, 2)]
+
+def test_checkpoints(fake_kafka, tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoints.sqlite')
+    engine_url = "kafka://fake/topic=foobar;start=0:0,1:0;"
+
+    c = KafkaConnector(engine_url=engine_url, checkpoint_file=checkpoint_file)
+    records = c.data
+    assert [next(records).n for _ in range(3)] == [0, 1, 2]
+    # interrupted. The last record given out may not have been dealt with.
+    records.close()
+
+    c = KafkaConnector(engine_url=engine_url, checkpoint_file=checkpoint_file)
+    assert [(r.p, r.n) for r in c][:2] == [(0, 2), (0, 3)]
+    assert c.checkpoint_store.load('fake', 'foobar') == {0: 10, 1: 10}
+
+    # nothing new
+    c = KafkaConnector(engine_url=engine_url, checkpoint_file=checkpoint_file)
+    assert [r for r in c] == []
+
+    # separately named checkpoints
+    c = KafkaConnector(engine_url=engine_url, checkpoint_file=checkpoint_file,
+                       checkpoint_name='other_model', concurrent_partitions=True)
+    assert len([r for r in c]) == 20
+
+def test_micro_batches(fake_kafka, tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoints.sqlite')
+    engine_url = "kafka://fake/topic=foobar;start=0:0,1:0;"
+    c = KafkaConnector(engine_url=engine_url, unbounded=True, checkpoint_file=checkpoint_file)
+    batches = c.micro_batches(max_records=4)
+    assert [r.n for r in next(batches)] == [0, 1, 2, 3]
+    assert [r.n for r in next(batches)] == [0, 1, 2, 3]
+    # first batch is committed once the second is asked for
+    assert c.checkpoint_store.load('fake', 'foobar') == {0: 4}
+    c.commit()
+    assert c.checkpoint_store.load('fake', 'foobar') == {0: 4, 1: 4}
+    batches.close()
+
+    # fewer than max_records are yielded once max_wait_s has passed
+    c = KafkaConnector(engine_url=engine_url, unbounded=True, checkpoint_file=checkpoint_file)
+    batches = c.micro_batches(max_records=100, max_wait_s=0.05)
+    assert sorted((r.p, r.n) for r in next(batches)) == \
+        [(p, n) for p in range(2) for n in range(4, 10)]
+    batches.close()
+
+    # stop while waiting for new messages
+    polls_left = [3]
+    def stop_after_polls():
+        polls_left[0] -= 1
+        return polls_left[0] < 0
+    c = KafkaConnector(engine_url="kafka://fake/topic=foobar;start=2:9;", unbounded=True)
+    assert [[r.n for r in b] for b in c.micro_batches(until=stop_after_polls)] == [[9]]
+
+def test_with_metadata(fake_kafka):
+    c = KafkaConnector(engine_url="kafka://fake/topic=foobar;start=1:3;end=1:5;",
+                       with_metadata=True)
+    records = [r for r in c]
+    assert [(r.topic, r.partition, r.offset, r.key) for r in records] == \
+        [('foobar', 1, 3, None), ('foobar', 1, 4, None)]
+    assert records[1].value.n == 4
+    assert records[1].timestamp == int(FAKE_START.timestamp() * 1000) + 4000
+
+    c = KafkaConnector(engine_url="kafka://fake/topic=foobar;start=1:3;end=1:4;",
+                       with_metadata=True, deserializer='raw')
+    assert [r.value for r in c] == [b'{"p": 1, "n": 3}']
+
+    with pytest.raises(ValueError):
+        KafkaConnector(engine_url="kafka://fake/topic=foobar;", deserializer='xml')
+
+def test_msgpack_deserializer(fake_kafka):
+    msgpack = pytest.importorskip('msgpack')
+
+    class MsgpackConsumer(FakeKafkaConsumer):
+        encode = staticmethod(msgpack.packb)
+
+    with patch('foxglove.connectors.kafka_connector.KafkaConsumer', MsgpackConsumer):
+        c = KafkaConnector(engine_url="kafka://fake/topic=foobar;start=0:3;end=0:5;",
+                           deserializer='msgpack')
+        assert [r.as_dict() for r in c] == [{'p': 0, 'n': 3}, {'p': 0, 'n': 4}]
+
+def test_avro_deserializer(fake_kafka, tmp_path):
+    fastavro = pytest.importorskip('fastavro')
+    schema = {'type': 'record', 'name': 'Message',
+              'fields': [{'name': 'p', 'type': 'int'}, {'name': 'n', 'type': 'long'}]}
+    schema_file = tmp_path / 'message.avsc'
+    schema_file.write_text(json.dumps(schema))
+    parsed_schema = fastavro.parse_schema(schema)
+
+    def avro_encode(doc):
+        f = io.BytesIO()
+        fastavro.schemaless_writer(f, parsed_schema, doc)
+        return f.getvalue()
+
+    class AvroConsumer(FakeKafkaConsumer):
+        encode = staticmethod(avro_encode)
+
+    with patch('foxglove.connectors.kafka_connector.KafkaConsumer', AvroConsumer):
+        c = KafkaConnector(engine_url="kafka://fake/topic=foobar;start=2:3;end=2:5;",
+                           deserializer='avro', avro_schema=str(schema_file),
+                           record_type='tuple', record_fields=['p', 'n'])
+        assert list(c.data) == [(2, 3), (2, 4)]
@@ -0,0 +1,24 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+import pytest
+
+from foxglove.deserializers import get_deserializer
+from foxglove.json_codec import get_codec
+
+
+def test_get_deserializer():
+    assert get_deserializer('json', json_backend='json') is get_codec('json')
+    assert get_deserializer('raw') is None
+    with pytest.raises(ValueError):
+        get_deserializer('xml')
+    with pytest.raises(ValueError):
+        get_deserializer('avro')
+
+def test_msgpack():
+    msgpack = pytest.importorskip('msgpack')
+    deserializer = get_deserializer('msgpack')
+    assert deserializer.loads(msgpack.packb({'name': 'Adder', 'legs': 0})) == \
+        {'name': 'Adder', 'legs': 0}
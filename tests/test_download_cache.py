@@ -0,0 +1,62 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+import os
+import threading
+import time
+
+from foxglove.connectors.download_cache import DownloadCache, download_cache
+
+
+def _writer(contents, calls):
+    def download(f):
+        calls.append(contents)
+        time.sleep(0.05)
+        f.write(contents)
+    return download
+
+def test_fetch(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    calls = []
+    path = cache.fetch(('bucket', 'a', 1), _writer(b'one', calls))
+    assert open(path, 'rb').read() == b'one'
+    assert cache.fetch(('bucket', 'a', 1), _writer(b'one', calls)) == path
+    # new version of object
+    path = cache.fetch(('bucket', 'a', 2), _writer(b'two', calls))
+    assert open(path, 'rb').read() == b'two'
+    assert calls == [b'one', b'two']
+    assert cache.stats == {'hits': 1, 'misses': 2}
+
+def test_fetch_concurrently(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    calls = []
+    threads = [threading.Thread(target=DownloadCache(cache_dir).fetch,
+                                args=(('bucket', 'a', 1), _writer(b'one', calls)))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == [b'one']
+
+def test_failed_download(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    def download(f):
+        f.write(b'partial')
+        raise OSError("Connection reset")
+    try:
+        cache.fetch(('bucket', 'a', 1), download)
+    except OSError:
+        pass
+    assert [f for f in os.listdir(cache.cache_dir) if not f.endswith('.lock')] == []
+
+def test_eviction(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'), max_bytes=25)
+    paths = [cache.fetch(('bucket', name, 1), _writer(b'x' * 10, []))
+             for name in ['a', 'b', 'c']]
+    assert [os.path.exists(p) for p in paths] == [False, True, True]
+    # another process could be holding the evicted object's lock
+    assert os.path.exists(paths[0] + DownloadCache.lock_suffix)
+    assert download_cache(cache.cache_dir) is download_cache(cache.cache_dir)
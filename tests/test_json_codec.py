@@ -0,0 +1,57 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+import os
+import pickle
+
+import pytest
+
+from foxglove.connect import Connect
+from foxglove.json_codec import available_backends, get_codec
+
+EXAMPLE_FLOWERPOT_PATH = os.path.dirname(os.path.abspath(__file__))\
+    +'/../integration-tests/exampleflowerpot.tar.gz'
+
+
+@pytest.mark.parametrize('backend', available_backends())
+def test_backends_agree(backend):
+    codec = get_codec(backend)
+    doc = {'name': 'Box jellyfish', 'legs': 0, 'tentacles': [1.5, None, True], 'where': {}}
+    assert codec.loads(b'{"name": "Box jellyfish", "legs": 0, '
+                       b'"tentacles": [1.5, null, true], "where": {}}') == doc
+    assert codec.loads(codec.dumps(doc)) == doc
+    assert isinstance(codec.dumps(doc), str)
+
+def test_auto_is_most_preferred():
+    assert get_codec('auto').name == available_backends()[0]
+    # stdlib is always there
+    assert 'json' in available_backends()
+
+def test_default_is_stdlib():
+    """
+    Fast backends can't read everything json.dumps writes so aren't used unless asked for.
+    """
+    codec = get_codec()
+    assert codec is get_codec('json')
+    doc = codec.loads(b'{"big": 123456789012345678901234567890, "nan": NaN}')
+    assert doc['big'] == 123456789012345678901234567890
+    assert doc['nan'] != doc['nan']
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_codec('not_a_json_library')
+
+def test_codec_can_be_pickled():
+    """
+    Codecs are sent to worker processes when reading in parallel.
+    """
+    codec = get_codec('json')
+    assert pickle.loads(pickle.dumps(codec)) is codec
+
+@pytest.mark.parametrize('backend', available_backends())
+def test_connect_json_backend(backend):
+    c = Connect(engine_url="flowerpot://"+EXAMPLE_FLOWERPOT_PATH, json_backend=backend)
+    assert len([r.availability for r in c]) == 4
+    assert c._local_dataset.codec.name == backend
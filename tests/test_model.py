@@ -0,0 +1,94 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+from io import StringIO
+import threading
+import time
+from unittest.mock import Mock, patch
+
+from google.cloud.storage import Bucket, Blob
+
+from foxglove import Connect, Model
+from foxglove.connectors.gcs_flowerpot import clear_gcs_pool
+from foxglove.connectors.kafka_connector import KafkaConnector, clear_metadata_cache
+
+from tests.test_connectors import EXAMPLE_FLOWERPOT_PATH
+from tests.test_connectors_kafka import FakeKafkaConsumer
+
+
+class TwoFlowerpots(Model):
+    insects = Connect(engine_url='gs+flowerpot://bucket/insects.flowerpot')
+    spiders = Connect(engine_url='gs+flowerpot://bucket/spiders.flowerpot')
+    local = Connect(engine_url='fake://example.com/abc')
+
+    def build(self):
+        self.counts = {'insects': len(list(self.insects.data)),
+                       'spiders': len(list(self.spiders.data))}
+
+
+def _slow_bucket(downloading):
+    def fake_object_download(file_handle):
+        downloading.append(threading.get_ident())
+        time.sleep(0.2)
+        with open(EXAMPLE_FLOWERPOT_PATH, 'rb') as f:
+            file_handle.write(f.read())
+
+    bucket = Mock(spec=Bucket)
+    blob = Mock(spec=Blob)
+    blob.download_to_file.side_effect = fake_object_download
+    bucket.get_blob.return_value = blob
+    return bucket
+
+
+@patch('google.cloud.storage.Client')
+def test_prefetch(fake_storage_client):
+    clear_gcs_pool()
+    downloading = []
+    fake_storage_client.return_value.get_bucket.return_value = _slow_bucket(downloading)
+
+    m = TwoFlowerpots()
+    m.log_to_stdout = False
+    external_log = StringIO()
+    m.set_logger(external_log)
+    m.prefetch = True
+
+    start = time.perf_counter()
+    m.go()
+    # both downloaded at the same time, once each
+    assert time.perf_counter() - start < 0.35
+    assert len(set(downloading)) == 2
+    assert m.counts == {'insects': 4, 'spiders': 4}
+
+    logs = external_log.getvalue()
+    assert 'Prefetched insects in' in logs
+    assert 'Prefetched spiders in' in logs
+    assert 'Prefetched local' not in logs
+    clear_gcs_pool()
+
+
+class CountingModel(Model):
+    def __init__(self, stop_after):
+        super().__init__()
+        self.stop_after = stop_after
+        self.batches = []
+
+    def build_batch(self, batch):
+        self.batches.append([r.n for r in batch])
+        if len(self.batches) == self.stop_after:
+            self.stop()
+
+
+def test_go_streaming(tmp_path):
+    clear_metadata_cache()
+    checkpoint_file = str(tmp_path / 'checkpoints.sqlite')
+    with patch('foxglove.connectors.kafka_connector.KafkaConsumer', FakeKafkaConsumer):
+        for expected in ([[0, 1, 2], [3, 4, 5]], [[6, 7, 8]]):
+            m = CountingModel(stop_after=len(expected))
+            m.log_to_stdout = False
+            topic = KafkaConnector(engine_url="kafka://fake/topic=foobar;start=0:0;",
+                                   unbounded=True, checkpoint_file=checkpoint_file)
+            m.go_streaming(topic, max_records=3)
+            assert m.batches == expected
+    clear_metadata_cache()
@@ -3,6 +3,10 @@
 Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
 
 """
+import pickle
+
+import pytest
+
 from foxglove.pinnate import Pinnate
 
 def test_attrib_and_dict():
@@ -17,3 +21,83 @@ def test_recurse():
     p = a.my_things
     assert p[0] == 1 and p[1] == 2 and isinstance(p[2], Pinnate)
     assert p[2].three == 3
+
+def test_wraps_without_copying():
+    d = {'animal': {'name': 'Adder'}}
+    a = Pinnate(d)
+    a.legs = 0
+    a['where'] = 'United Kingdom'
+    assert d == {'animal': {'name': 'Adder'}, 'legs': 0, 'where': 'United Kingdom'}
+    assert not hasattr(a, '__dict__')
+
+def test_nested_wrappers_are_cached():
+    a = Pinnate({'animal': {'name': 'Adder'}, 'my_things': [1, {'three': 3}]})
+    assert a.animal is a.animal
+    assert a['animal'] is a.animal
+    assert a.my_things[0] == 1
+    assert a.my_things[1].three == 3
+
+    # replacing a value replaces the wrapper
+    a.animal = {'name': 'King Cobra'}
+    assert a.animal.name == 'King Cobra'
+
+def test_wrappers_follow_replaced_values():
+    d = {'a': {'x': 1}}
+    p = Pinnate(d)
+    assert p.a.x == 1
+    d['a'] = {'x': 99}
+    assert p.a.x == 99
+    assert p['a'].x == 99
+
+def test_list_attributes_match_record():
+    p = Pinnate({'l': [1, 2]})
+    p.l.append(3)
+    assert p.l == p.as_dict()['l'] == [1, 2]
+    p['l'].append(3)
+    assert p.l == p.as_dict()['l'] == [1, 2, 3]
+
+def test_as_dict_is_a_copy():
+    d = {'animal': {'name': 'Adder'}}
+    a = Pinnate(d)
+    a.animal.name = 'Gila Monster'
+    as_dict = a.as_dict()
+    assert as_dict == {'animal': {'name': 'Gila Monster'}}
+    as_dict['animal']['name'] = 'Indian Krait'
+    assert a.animal.name == 'Gila Monster'
+
+def test_load_json_and_merge():
+    a = Pinnate('{"animal": {"name": "Adder"}, "legs": 0}')
+    a.merge({'animal': {'where': 'United Kingdom'}})
+    assert a.as_dict() == {'animal': {'name': 'Adder', 'where': 'United Kingdom'}, 'legs': 0}
+
+    with pytest.raises(ValueError):
+        a.merge({'animal': 'not a dict'})
+    with pytest.raises(ValueError):
+        a.merge({'legs': {'front': 0}})
+
+def test_merge_and_update_copy_nested_dicts():
+    d = {'a': {'x': 1}}
+    p = Pinnate()
+    p.merge(d)
+    p.merge({'a': {'y': 2}})
+    assert d == {'a': {'x': 1}}
+    assert p.as_dict() == {'a': {'x': 1, 'y': 2}}
+
+    d = {'a': {'x': 1}}
+    p = Pinnate()
+    p.update(d)
+    p.a.x = 2
+    assert d == {'a': {'x': 1}}
+
+def test_missing_attribute():
+    a = Pinnate({'my_string':'abcdef'})
+    with pytest.raises(AttributeError):
+        a.not_there
+    assert a.get('not_there', 'default') == 'default'
+
+def test_pickle():
+    a = Pinnate({'animal': {'name': 'Adder'}})
+    assert a.animal.name == 'Adder'
+    b = pickle.loads(pickle.dumps(a))
+    assert b.as_dict() == a.as_dict()
+    assert b.animal.name == 'Adder'
@@ -0,0 +1,117 @@
+"""
+
+Copyright 2019 BBC. Licensed under the terms of the Apache License 2.0.
+
+"""
+import json
+import pickle
+
+import pytest
+
+from foxglove.deserializers import Deserializer
+from foxglove.pinnate import Pinnate
+from foxglove.records import RecordDecoder, RecordFilter, RecordType
+
+LINE = b'{"name": "Adder", "where": "United Kingdom", "legs": 0}'
+
+def test_record_types():
+    assert isinstance(RecordDecoder().decode(LINE), Pinnate)
+    assert RecordDecoder(record_type='dict').decode(LINE) == \
+        {"name": "Adder", "where": "United Kingdom", "legs": 0}
+    assert RecordDecoder(record_type=RecordType.RAW).decode(LINE) is LINE
+    decoder = RecordDecoder(record_type='tuple', fields=['where', 'name', 'not_there'])
+    assert decoder.decode(LINE) == ('United Kingdom', 'Adder', None)
+
+def test_tuple_needs_fields():
+    with pytest.raises(ValueError):
+        RecordDecoder(record_type='tuple')
+
+def test_unknown_record_type():
+    with pytest.raises(ValueError):
+        RecordDecoder(record_type='not_a_record_type')
+
+def test_derive():
+    decoder = RecordDecoder(record_type='tuple', fields=['name'])
+    derived = decoder.derive(record_type=RecordType.DICT)
+    assert derived.record_type == RecordType.DICT
+    assert derived.fields == ['name']
+    assert decoder.record_type == RecordType.TUPLE
+
+def test_decoder_can_be_pickled():
+    decoder = RecordDecoder(record_type='tuple', fields=['name'])
+    assert pickle.loads(pickle.dumps(decoder)).decode(LINE) == ('Adder',)
+
+def test_columns():
+    decoder = RecordDecoder(record_type='dict', columns=['name', 'not_there'])
+    assert decoder.decode(LINE) == {'name': 'Adder'}
+    assert RecordDecoder(columns=['legs', 'name']).decode(LINE).as_dict() == \
+        {'legs': 0, 'name': 'Adder'}
+    # columns give the fields for tuples
+    assert RecordDecoder(record_type='tuple', columns=['legs']).decode(LINE) == (0,)
+
+def test_columns_not_with_raw():
+    with pytest.raises(ValueError):
+        RecordDecoder(record_type='raw', columns=['name'])
+
+def test_filter_conditions():
+    doc = {'name': 'Box jellyfish', 'where': 'Australia', 'legs': 0,
+           'habitat': {'terrain': 'reef'}}
+    assert RecordFilter({'where': 'Australia', 'legs': 0}).matches(doc)
+    assert not RecordFilter({'where': 'India'}).matches(doc)
+    assert RecordFilter([('legs', '<', 4), ('habitat.terrain', '==', 'reef')]).matches(doc)
+    assert RecordFilter([('where', 'in', ['India', 'Australia'])]).matches(doc)
+    assert RecordFilter([('not_there', '==', None)]).matches(doc)
+    assert not RecordFilter([('habitat.terrain.depth', '==', 1), ]).matches(doc)
+    assert RecordFilter(lambda d: d['name'].startswith('Box')).matches(doc)
+    assert not RecordFilter([('legs', '!=', 0), lambda d: True]).matches(doc)
+
+    with pytest.raises(ValueError):
+        RecordFilter([('legs', '~', 0)])
+
+def test_filter_heterogeneous_records():
+    docs = [{'name': 'Adder', 'legs': 0}, {'name': 'Box jellyfish'}, {'name': 'x', 'legs': 'none'},
+            {'name': 'Funnel-web', 'legs': 8}]
+    f = RecordFilter([('legs', '<', 4)])
+    assert [d['name'] for d in docs if f.matches(d)] == ['Adder']
+    f = RecordFilter([('legs', '>=', 4)])
+    assert [d['name'] for d in docs if f.matches(d)] == ['Funnel-web']
+
+def test_filter_bool_isnt_number():
+    lines = [b'{"x": true}', b'{"x": 1}', b'{"x": 1.0}']
+    decoder = RecordDecoder(record_type='raw', where={'x': 1})
+    assert list(decoder.decode_all(lines)) == lines[1:]
+    assert [RecordFilter({'x': 1}).matches(json.loads(l)) for l in lines] == [False, True, True]
+    assert [RecordFilter({'x': True}).matches(json.loads(l)) for l in lines] == [True, False, False]
+    assert RecordFilter([('x', '!=', 1)]).matches({'x': True})
+
+def test_filter_might_match():
+    f = RecordFilter({'where': 'Australia', 'legs': 10, 'venomous': True})
+    assert f.might_match(b'{"where": "Australia", "legs": 10, "venomous": true}')
+    assert f.might_match('{"venomous":true,"legs":10,"where":"Australia"}')
+    assert not f.might_match(b'{"where": "India", "legs": 10, "venomous": true}')
+    assert not f.might_match(b'{"where": "Australia", "legs": 8, "venomous": true}')
+
+    # values that might be escaped can't be checked before deserializing
+    assert RecordFilter({'where': 'café/bar'}).might_match(b'{"where": "caf\\u00e9\\/bar"}')
+    assert RecordFilter({'where': 'x'}).might_match(b'{"where": "y"}') is False
+    assert RecordFilter({'weight': 1.5}).might_match(b'{"weight": 1.50}')
+
+def test_decode_all_where():
+    lines = [b'{"name": "Adder", "where": "United Kingdom"}',
+             b'{"name": "King Cobra", "where": "India"}',
+             b'{"name": "Indian Krait", "where": "India", "note": "United Kingdom"}',
+             ]
+    decoder = RecordDecoder(record_type='tuple', fields=['name'],
+                            where={'where': 'United Kingdom'})
+    assert list(decoder.decode_all(lines)) == [('Adder',)]
+
+    decoder = RecordDecoder(record_type='raw', where=[('where', '!=', 'United Kingdom')])
+    assert list(decoder.decode_all(lines)) == lines[1:]
+
+def test_where_with_binary_records():
+    """
+    Records that aren't JSON text can't be searched before being deserialized.
+    """
+    deserializer = Deserializer('reversed', lambda raw: {'name': raw[::-1].decode()})
+    decoder = RecordDecoder(deserializer, record_type='dict', where={'name': 'Adder'})
+    assert list(decoder.decode_all([b'reddA', b'reggaB'])) == [{'name': 'Adder'}]